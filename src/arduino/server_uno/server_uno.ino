@@ -112,7 +112,10 @@ void loop() //процедура loop
   }
   else if (is_cmd("ping"))
   {
+    // echo 'ping:seq,stamp;' back, client measures round trip
+    Serial.write("ping:");
     Serial.write(val);
+    Serial.write(";");
   }
   else if (is_cmd("laser"))
   {
@@ -0,0 +1,784 @@
+#!/usr/bin/python3.4
+# @file bench.py
+# Off-brick benchmarks, ev3server runs with the emulator backend.
+# usage: bench.py <benchmark> [options]
+
+import os
+import sys
+import json
+import time
+import heapq
+import queue
+import random
+import signal
+import socket
+import argparse
+import tempfile
+import contextlib
+import importlib.machinery
+import resource
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ev3server'))
+
+import ev3proto
+import ev3server
+
+# Server log is written after the import, reports alone go to stdout
+ev3server.log.stream = sys.stderr
+
+DISPATCH_CMDS = [('drive', '0.3,0.3'),
+                 ('xy', '-0.3,0.3'),
+                 ('gear', '3'),
+                 ('led', 'green'),
+                 ('arm', '100')]
+
+def timeit(func, count):
+   start = time.perf_counter()
+   for i in range(count):
+      func()
+   return (time.perf_counter() - start) / count
+
+def benchDispatch(args):
+   '''Per command cost of EV3Server.handle() vs calling the handler directly'''
+   server = ev3server.EV3Server(0, True)
+   print('{:<8} {:>12} {:>12} {:>12}'.format('cmd', 'handle, us', 'direct, us', 'overhead, us'))
+   for cmd, value in DISPATCH_CMDS:
+      handler = server.commands.get(cmd)
+      parsed = handler.parse(value)
+      viaHandle = timeit(lambda: server.handle(cmd, value), args.count)
+      direct = timeit(lambda: handler.func(parsed), args.count)
+      print('{:<8} {:>12.2f} {:>12.2f} {:>12.2f}'.format(cmd, viaHandle * 1e6, direct * 1e6, (viaHandle - direct) * 1e6))
+
+   if hasattr(ev3server.ev3, 'stats'):
+      sim = ev3server.ev3.stats()
+      print()
+      print('sim sysfs:  {} reads, {} writes'.format(sim['reads'], sim['writes']))
+
+   print()
+   print('{:<8} {:>10} {:>10}'.format('motor', 'writes', 'elided'))
+   for name, stats in sorted(server.motorStats().items()):
+      print('{:<8} {:>10} {:>10}'.format(name, stats['writes'], stats['elided']))
+
+   print()
+   print('{:<8} {:>10} {:>10} {:>10}'.format('cmd', 'count', 'avg, us', 'max, us'))
+   for name, stats in sorted(server.commands.stats().items()):
+      if stats['count']:
+         print('{:<8} {:>10} {:>10.2f} {:>10.2f}'.format(name, stats['count'], stats['avg'] * 1e6, stats['max'] * 1e6))
+
+PROTOCOL_CMDS = [('drive', '-0.3,-0.3'),
+                 ('xy', '0.25,-0.75'),
+                 ('gear', '3'),
+                 ('speak', 'Hello, I am Curiosity mars rover')]
+
+def benchProtocol(args):
+   '''Encode/decode cost and bytes per command of text and binary framing'''
+   server = ev3server.EV3Server(0, True)
+   print('{:<7} {:<7} {:>6} {:>11} {:>11}'.format('cmd', 'proto', 'bytes', 'encode, us', 'decode, us'))
+   for cmd, value in PROTOCOL_CMDS:
+      parse = server.commands.get(cmd).parse
+      encoders = [('text', lambda: '{}:{};'.format(cmd, value).encode()),
+                  ('binary', lambda: ev3proto.encode(cmd, value))]
+      for proto, encode in encoders:
+         frame = encode()
+         parser = ev3server.CmdParser()
+         if proto == 'text':
+            # Text value is parsed by the handler
+            decode = lambda: parse(parser.feed(frame)[0].split(':', 1)[1])
+         else:
+            decode = lambda: parser.feed(frame)[0]
+         print('{:<7} {:<7} {:>6} {:>11.2f} {:>11.2f}'.format(cmd, proto, len(frame),
+                                                           timeit(encode, args.count) * 1e6,
+                                                           timeit(decode, args.count) * 1e6))
+
+def freePort(kind = socket.SOCK_STREAM):
+   s = socket.socket(socket.AF_INET, kind)
+   s.bind(('127.0.0.1', 0))
+   port = s.getsockname()[1]
+   s.close()
+   return port
+
+def writeReport(path, report):
+   with open(path, 'w') as f:
+      json.dump(report, f)
+
+def serve(args):
+   '''Runs emulated EV3Server in this process until SIGINT, --report writes what it handled as JSON'''
+   server = ev3server.EV3Server(args.port, True, udpPort=args.udp_port)
+   # e2e marker commands, monotonic clock is system wide so the parent compares stamps with its own
+   arrived = {}
+   server.commands.register('bench', lambda value: arrived.setdefault(value, time.monotonic()))
+   try:
+      server.start()
+      server.accept()
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.stop()
+      if args.report:
+         writeReport(args.report, {'arrived': arrived, 'handled': server.commands.stats(), 'motion': server.motionStats})
+
+class ServerProcess:
+   '''EV3Server, or another benchmark command, in a child process, so its cpu time is measured separately from the clients'''
+   def __init__(self, port, args, extra = None, command = 'serve'):
+      self.port = port
+      self.command = command
+      self.__process = subprocess.Popen([sys.executable, os.path.abspath(__file__), command, '--port', str(port),
+                                         '--read-latency', str(args.read_latency),
+                                         '--write-latency', str(args.write_latency)] + (extra or []),
+                                        stdout=subprocess.DEVNULL)
+      self.__waitListening()
+      self.__started = time.time()
+
+   def __waitListening(self):
+      '''Server sends telemetry as soon as it serves peers'''
+      while True:
+         try:
+            s = socket.create_connection(('127.0.0.1', self.port))
+            break
+         except ConnectionRefusedError:
+            time.sleep(0.1)
+      if self.command == 'serve':
+         s.recv(128)
+      s.close()
+
+   def stop(self):
+      '''Returns (wall, cpu) seconds of this child process'''
+      before = resource.getrusage(resource.RUSAGE_CHILDREN)
+      self.__process.send_signal(signal.SIGINT)
+      self.__process.wait()
+      wall = time.time() - self.__started
+      usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+      return wall, usage.ru_utime + usage.ru_stime - before.ru_utime - before.ru_stime
+
+class BenchClient:
+   '''Counts received telemetry, the controller also sends drive commands at a fixed rate'''
+   def __init__(self, port):
+      self.sock = socket.create_connection(('127.0.0.1', port))
+      self.sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+      self.received = {}
+      self.sent = 0
+      self.__buffer = b''
+      self.__thread = threading.Thread(target=self.__readLoop)
+      self.__thread.daemon = True
+      self.__thread.start()
+
+   def __readLoop(self):
+      while True:
+         try:
+            data = self.sock.recv(4096)
+         except OSError:
+            return
+         if not data:
+            return
+         frames = (self.__buffer + data).split(b';')
+         self.__buffer = frames.pop()
+         for frame in frames:
+            key = frame.split(b':', 1)[0].decode()
+            self.received[key] = self.received.get(key, 0) + 1
+
+   def send(self, cmds):
+      self.sock.sendall(cmds.encode())
+      self.sent += 1
+
+   def close(self):
+      self.sock.close()
+
+def benchClients(args):
+   '''Many peers: one controller drives, everybody receives telemetry'''
+   server = ServerProcess(freePort(), args)
+   clients = [BenchClient(server.port) for i in range(args.clients)]
+   controller = clients[0]
+   controller.send('control:take;')
+   time.sleep(0.1)
+   for client in clients[1:]:
+      client.send('drive:0.1,0.1;')
+
+   start = time.time()
+   i = 0
+   while time.time() - start < args.duration:
+      controller.send('drive:{0:.2f},{0:.2f};'.format((i % 100) / 100))
+      i += 1
+      time.sleep(1.0 / args.rate)
+   time.sleep(0.2)
+
+   for client in clients:
+      client.close()
+   wall, cpu = server.stop()
+
+   spectators = clients[1:]
+   print('clients:              {}'.format(len(clients)))
+   print('drive commands:       {} ({:.0f}/s)'.format(controller.sent, controller.sent / args.duration))
+   print('denied to spectators: {}/{}'.format(sum(c.received.get('error', 0) for c in spectators), len(spectators)))
+   telemetry = [sum(c.received.get(key, 0) for key in ['tm', 'ping', 'ir', 'power']) / args.duration for c in clients]
+   print('telemetry per client: min {:.2f}/s max {:.2f}/s'.format(min(telemetry), max(telemetry)))
+   print('server cpu:           {:.2f}s of {:.2f}s ({:.1f}%)'.format(cpu, wall, cpu / wall * 100))
+
+def queryStats(port, keys):
+   '''stats:<key> replies in the order asked, as dicts. Replies carry no key, so they are read on own connection'''
+   stats = socket.create_connection(('127.0.0.1', port))
+   stats.sendall(('telemetry:off;' + ''.join('stats:{};'.format(key) for key in keys)).encode())
+   stats.settimeout(2)
+   reply = b''
+   try:
+      while reply.count(b'stats:') < len(keys) or not reply.endswith(b';'):
+         data = stats.recv(4096)
+         if not data:
+            break
+         reply += data
+   except socket.timeout:
+      pass
+   stats.close()
+   frames = [frame.partition('stats:')[2] for frame in reply.decode().split(';') if frame.startswith('stats:')]
+   return [dict(item.split('=', 1) for item in frame.split(',') if '=' in item) for frame in frames] + \
+          [{}] * (len(keys) - len(frames))
+
+def benchIdle(args):
+   '''Server cpu and loop wakeups with a connected but silent peer'''
+   server = ServerProcess(freePort(), args)
+   client = BenchClient(server.port)
+   time.sleep(args.duration)
+
+   loop, sim = queryStats(server.port, ['loop', 'sim'])
+   client.close()
+   wall, cpu = server.stop()
+
+   print('idle:                 {:.1f}s'.format(args.duration))
+   print('server cpu:           {:.3f}s of {:.2f}s ({:.2f}%)'.format(cpu, wall, cpu / wall * 100))
+   if 'wakeups' in loop:
+      print('loop wakeups:         {:.1f}/s'.format(int(loop['wakeups']) / wall))
+   print('telemetry received:   {}'.format(sum(client.received.values())))
+   if sim:
+      print('sim sysfs:            {:.1f} reads/s, {:.1f} writes/s'.format(int(sim['reads']) / wall, int(sim['writes']) / wall))
+
+class LossyRelay:
+   '''UDP relay that drops, delays and reorders datagrams: loss is 0..1, delay and jitter are seconds'''
+   def __init__(self, port, loss, delay, jitter):
+      self.target = ('127.0.0.1', port)
+      self.loss = loss
+      self.delay = delay
+      self.jitter = jitter
+      self.dropped = 0
+      self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self.__socket.bind(('127.0.0.1', 0))
+      self.port = self.__socket.getsockname()[1]
+      self.__out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self.__heap = []
+      self.__cond = threading.Condition()
+      for target in [self.__recvLoop, self.__sendLoop]:
+         thread = threading.Thread(target=target)
+         thread.daemon = True
+         thread.start()
+
+   def __recvLoop(self):
+      while True:
+         data = self.__socket.recv(256)
+         if random.random() < self.loss:
+            self.dropped += 1
+            continue
+         due = time.monotonic() + self.delay + random.uniform(0, self.jitter)
+         with self.__cond:
+            heapq.heappush(self.__heap, (due, data))
+            self.__cond.notify()
+
+   def __sendLoop(self):
+      while True:
+         with self.__cond:
+            while not self.__heap or self.__heap[0][0] > time.monotonic():
+               self.__cond.wait(self.__heap[0][0] - time.monotonic() if self.__heap else None)
+            due, data = heapq.heappop(self.__heap)
+         self.__out.sendto(data, self.target)
+
+def percentile(values, p):
+   values = sorted(values)
+   return values[min(len(values) - 1, int(len(values) * p / 100))] if values else float('nan')
+
+def benchUdp(args):
+   '''Motion setpoints over a lossy, reordering UDP link: only the newest one is applied'''
+   server = ev3server.EV3Server(0, True, udpPort=0)
+   applied = []
+   # Plugin drive handler records which setpoint arrived and when
+   server.commands.register('drive', lambda value: applied.append((time.monotonic(), int(value[0]))), ev3server.floats, motion=True)
+   server.start()
+   thread = threading.Thread(target=server.accept)
+   thread.daemon = True
+   thread.start()
+
+   token = random.getrandbits(32)
+   control = socket.create_connection(('127.0.0.1', server.port))
+   control.sendall('udp:{};control:take;'.format(token).encode())
+   time.sleep(0.2)
+
+   relay = LossyRelay(server.udpPort, args.loss, args.delay, args.jitter)
+   sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+   sent = {}
+   start = time.time()
+   seq = 0
+   while time.time() - start < args.duration:
+      seq += 1
+      sent[seq] = time.monotonic()
+      sock.sendto(ev3proto.encodeMotion(token, seq, sent[seq], 'drive', '{},0'.format(seq)), ('127.0.0.1', relay.port))
+      time.sleep(1.0 / args.rate)
+   time.sleep(args.delay + args.jitter + 0.2)
+
+   order = [i for t, i in applied]
+   latency = [(t - sent[i]) * 1000 for t, i in applied]
+   print('sent:                 {}'.format(seq))
+   print('dropped by relay:     {} ({:.0%})'.format(relay.dropped, relay.dropped / seq))
+   print('applied:              {}'.format(len(applied)))
+   print('stale ignored:        {}'.format(server.motionStats['stale']))
+   print('applied in order:     {}'.format(order == sorted(order)))
+   print('newest applied:       {} of {}'.format(order[-1] if order else None, seq))
+   print('latency, ms:          p50 {:.2f} p99 {:.2f}'.format(percentile(latency, 50), percentile(latency, 99)))
+   control.close()
+   server.stop()
+
+CLIENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client', 'ev3client.py')
+
+def loadClient(path):
+   '''ev3client reads its config and images relative to the working directory'''
+   os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+   os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+   os.chdir(os.path.dirname(os.path.abspath(path)))
+   sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+   client = importlib.machinery.SourceFileLoader('ev3client', path).load_module()
+   if hasattr(client, 'log'):
+      # Benchmarks do not leave log files in the client folder
+      client.log.open(None)
+   return client
+
+class FakeFrames:
+   '''WebFrame stand-in, cycles synthetic camera frames at a fixed rate'''
+   def __init__(self, pygame, size, fps, notify = None):
+      self.__notify = notify
+      self.__frames = []
+      for i in range(8):
+         frame = pygame.Surface(size).convert()
+         frame.fill((i * 30, 80, 255 - i * 30))
+         pygame.draw.circle(frame, (255, 255, 255), (size[0] // 8 * (i + 1) - size[0] // 16, size[1] // 2), 40)
+         self.__frames.append(frame)
+      self.__frame = self.__frames[0]
+      self.shown = 0
+      self.started = True
+      thread = threading.Thread(target=self.__loop, args=(1.0 / fps,))
+      thread.daemon = True
+      thread.start()
+
+   def __loop(self, interval):
+      i = 0
+      while self.started:
+         time.sleep(interval)
+         i += 1
+         self.__frame = self.__frames[i % len(self.__frames)]
+         if self.__notify is not None:
+            self.__notify()
+
+   def getFrame(self):
+      self.shown += 1
+      return self.__frame
+
+   def stop(self):
+      self.started = False
+
+class FakeTransport:
+   '''CmdTransport stand-in, answers with telemetry frames at a fixed rate'''
+   def __init__(self, rate, pings):
+      self.in_queue = queue.Queue()
+      self.__pings = pings
+      self.sent = 0
+      self.started = True
+      thread = threading.Thread(target=self.__loop, args=(1.0 / rate,))
+      thread.daemon = True
+      thread.start()
+
+   def __loop(self, interval):
+      seq = 0
+      ir = 50
+      while self.started:
+         time.sleep(interval)
+         seq += 1
+         now = time.monotonic()
+         ir = max(0, min(100, ir + random.randint(-3, 3)))
+         self.in_queue.put('tm:{},{:.3f},ping=1@{:.3f},ir={}@{:.3f},power=7.50@{:.3f};'.format(seq, now, now, ir, now, now))
+
+   def send(self, cmd, coalesce = True):
+      self.sent += 1
+
+   def pings(self):
+      return self.__pings
+
+   def exportPings(self, path):
+      pass
+
+   def reconnectEv3(self):
+      pass
+
+   def stop(self):
+      self.started = False
+
+def benchHud(args):
+   '''Client cpu of RoboControl rendering on a scripted session: camera frames, telemetry and key presses.
+      With --session a recorded drive is replayed instead, the same input on every run'''
+   client = loadClient(args.client)
+   import pygame
+
+   replay = None
+   if args.session:
+      replay = client.Replay(args.session, args.speed, loop=True)
+
+   frames = []
+   transports = []
+   def webFrame(ip, port, notify = None, record = None):
+      frames.append(FakeFrames(pygame, client.FRAME_SIZE, args.fps, notify))
+      return frames[-1]
+   def cmdTransport(*args, **kwargs):
+      transports.append(FakeTransport(5, {client.ARDUINO_CMD: client.PingStats(), client.EV3_CMD: client.PingStats()}))
+      return transports[-1]
+   client.WebFrame = webFrame
+   client.CmdTransport = cmdTransport
+
+   # Screen pushes are counted whatever way the client does them
+   pushed = {'calls': 0, 'pixels': 0}
+   flip, update = pygame.display.flip, pygame.display.update
+   def countFlip():
+      pushed['calls'] += 1
+      pushed['pixels'] += client.SCREEN_SIZE[0] * client.SCREEN_SIZE[1]
+      flip()
+   def countUpdate(rects = None):
+      if rects is None:
+         return countFlip()
+      pushed['calls'] += 1
+      if isinstance(rects, pygame.Rect):
+         rects = [rects]
+      pushed['pixels'] += sum(rect.width * rect.height for rect in rects)
+      update(rects)
+   pygame.display.flip = countFlip
+   pygame.display.update = countUpdate
+
+   def session():
+      keys = [pygame.K_1, pygame.K_2, pygame.K_3]
+      deadline = time.time() + args.duration
+      i = 0
+      while time.time() < deadline:
+         time.sleep(1)
+         pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_UP, mod=0))
+         time.sleep(0.3)
+         pygame.event.post(pygame.event.Event(pygame.KEYUP, key=pygame.K_UP, mod=0))
+         pygame.event.post(pygame.event.Event(pygame.KEYUP, key=keys[i % len(keys)], mod=0))
+         i += 1
+      pygame.event.post(pygame.event.Event(pygame.QUIT))
+   thread = threading.Thread(target=session)
+   thread.daemon = True
+
+   control = client.RoboControl()
+   start, cpu = time.time(), time.process_time()
+   thread.start()
+   try:
+      if replay is not None:
+         control.run(replay=replay)
+      else:
+         control.run()
+   except SystemExit:
+      pass
+   wall, cpu = time.time() - start, time.process_time() - cpu
+
+   print('client:               {}'.format(os.path.abspath(args.client)))
+   if replay is not None:
+      stats = replay.stats()
+      print('session:              {}, x{:g}'.format(replay.session.path, args.speed))
+      print('camera:               {} frames played, {} skipped, {} taken'.format(stats['frames'], stats['skipped'], stats['shown']))
+   else:
+      print('camera:               {:.0f} fps, {} frames taken'.format(args.fps, frames[0].shown))
+   print('client cpu:           {:.2f}s of {:.2f}s ({:.1f}%)'.format(cpu, wall, cpu / wall * 100))
+   print('screen pushes:        {:.1f}/s'.format(pushed['calls'] / wall))
+   print('pixels pushed:        {:.2f}M/s'.format(pushed['pixels'] / wall / 1e6))
+   if hasattr(control, 'telemetryStats'):
+      print('telemetry lost:       {lost} of {seq}'.format(**control.telemetryStats()))
+
+class ArduinoStandIn:
+   '''server_uno.ino protocol as the MR3020 serial bridge exposes it on TCP: 'cmd:val;' in,
+      ping value echoed back, turn and cam print debug lines like the sketch does'''
+   ValueSize = 15   # sketch value buffer is 16 chars with the terminating zero
+
+   def __init__(self, onCommand, port = 0):
+      self.onCommand = onCommand
+      self.received = 0
+      self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.__socket.bind(('127.0.0.1', port))
+      self.__socket.listen(4)
+      self.port = self.__socket.getsockname()[1]
+      thread = threading.Thread(target=self.__acceptLoop)
+      thread.daemon = True
+      thread.start()
+
+   def __acceptLoop(self):
+      while True:
+         conn, addr = self.__socket.accept()
+         thread = threading.Thread(target=self.__serve, args=(conn,))
+         thread.daemon = True
+         thread.start()
+
+   def __serve(self, conn):
+      buffer = b''
+      while True:
+         try:
+            data = conn.recv(4096)
+         except OSError:
+            return
+         if not data:
+            return
+         frames = (buffer + data).split(b';')
+         buffer = frames.pop()
+         reply = b''
+         for frame in frames:
+            cmd, _, value = frame.decode('utf-8', 'replace').partition(':')
+            value = value[:self.ValueSize]
+            self.received += 1
+            self.onCommand(cmd, value)
+            if cmd == 'ping':
+               reply += 'ping:{};'.format(value).encode()
+            elif cmd in ['turn', 'cam']:
+               reply += '{}{}\r\n'.format(value, value).encode()
+         if reply:
+            conn.sendall(reply)
+
+class FakeStreamer:
+   '''mjpg-streamer stand-in: ?action=stream serves canned jpegs as multipart at fps, ?action=snapshot one per request'''
+   Boundary = b'boundarydonotcross'
+
+   def __init__(self, jpegs, fps, port = 0):
+      self.jpegs = jpegs
+      self.interval = 1.0 / fps
+      self.served = 0
+      self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.__socket.bind(('127.0.0.1', port))
+      self.__socket.listen(4)
+      self.port = self.__socket.getsockname()[1]
+      thread = threading.Thread(target=self.__acceptLoop)
+      thread.daemon = True
+      thread.start()
+
+   def __acceptLoop(self):
+      while True:
+         conn, addr = self.__socket.accept()
+         thread = threading.Thread(target=self.__serve, args=(conn,))
+         thread.daemon = True
+         thread.start()
+
+   def __serve(self, conn):
+      try:
+         request = b''
+         while True:
+            while b'\r\n\r\n' not in request:
+               data = conn.recv(4096)
+               if not data:
+                  return
+               request += data
+            head, _, request = request.partition(b'\r\n\r\n')
+            if b'action=stream' in head:
+               self.__stream(conn)
+               return
+            jpeg = self.__next()
+            conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                         str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg)
+      except OSError:
+         pass
+      finally:
+         conn.close()
+
+   def __stream(self, conn):
+      conn.sendall(b'HTTP/1.0 200 OK\r\nContent-Type: multipart/x-mixed-replace;boundary=' + self.Boundary + b'\r\n\r\n')
+      deadline = time.time()
+      while True:
+         jpeg = self.__next()
+         conn.sendall(b'--' + self.Boundary + b'\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                      str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+         deadline += self.interval
+         time.sleep(max(0, deadline - time.time()))
+
+   def __next(self):
+      self.served += 1
+      return self.jpegs[self.served % len(self.jpegs)]
+
+CANNED_JPEGS = ['tunnel.jpg', 'bluedoor.jpg', 'cam.jpg']
+
+def standIns(args):
+   '''Arduino and camera stand-ins of e2e in this process until SIGINT, camera listens on --port'''
+   arrived = {}
+   arduino = ArduinoStandIn(lambda cmd, value: cmd == 'laser' and arrived.setdefault(value, time.monotonic()), args.arduino_port)
+   jpegs = []
+   for name in CANNED_JPEGS:
+      with open(os.path.join(args.images, name), 'rb') as f:
+         jpegs.append(f.read())
+   camera = FakeStreamer(jpegs, args.fps, args.port)
+   try:
+      while True:
+         time.sleep(1)
+   except KeyboardInterrupt:
+      pass
+   if args.report:
+      writeReport(args.report, {'arrived': arrived, 'received': arduino.received, 'served': camera.served})
+
+def percentiles(values):
+   '''Milliseconds summary of seconds, None when there are no values'''
+   if not values:
+      return None
+   return {'count': len(values),
+           'p50': percentile(values, 50) * 1000,
+           'p90': percentile(values, 90) * 1000,
+           'p99': percentile(values, 99) * 1000,
+           'max': max(values) * 1000}
+
+def benchE2e(args):
+   '''CmdTransport and WebFrame against EV3Server, arduino and camera stand-ins, prints JSON.
+      Server and stand-ins run in child processes, so client cpu is measured alone'''
+   client = loadClient(args.client)
+   client.CAMERA_MODE = args.camera
+   dests = [client.EV3_CMD, client.ARDUINO_CMD]
+
+   # Marker commands carry their number, arrival is stamped by the receiving process
+   sent = dict((dest, {}) for dest in dests)
+   reports = tempfile.TemporaryDirectory()
+   serverReport = os.path.join(reports.name, 'server.json')
+   standInsReport = os.path.join(reports.name, 'stand-ins.json')
+
+   udpPort = freePort(socket.SOCK_DGRAM) if args.udp else None
+   server = ServerProcess(freePort(), args, ['--report', serverReport] + (['--udp-port', str(udpPort)] if args.udp else []))
+   arduinoPort = freePort()
+   standIns = ServerProcess(freePort(), args, ['--report', standInsReport, '--arduino-port', str(arduinoPort),
+                                                '--images', os.path.abspath(client.IMG_FOLDER), '--fps', str(args.fps)], 'stand-ins')
+
+   # Client output goes to stderr, stdout is left for the report
+   client.log.stream = sys.stderr
+   with contextlib.redirect_stdout(sys.stderr):
+      client.EV3_UDP_PORT = udpPort
+
+      recorder = None
+      if args.record:
+         import session
+         recorder = session.Recorder(os.path.abspath(args.record), {'version': client.__version__, 'frame-size': client.FRAME_SIZE})
+
+      start, cpu = time.time(), time.process_time()
+      transport = client.CmdTransport('127.0.0.1', arduinoPort, server.port, recorder)
+      frames = client.WebFrame('127.0.0.1', standIns.port, record=recorder.frame if recorder else None)
+
+      shown = [0]
+      def display():
+         last = None
+         while frames.started:
+            frame = frames.getFrame()
+            if frame is not last:
+               shown[0] += 1
+               last = frame
+            time.sleep(1.0 / client.MAX_FPS)
+      thread = threading.Thread(target=display)
+      thread.daemon = True
+      thread.start()
+
+      # Links are up before the clock starts
+      time.sleep(0.5)
+      i = 0
+      deadline = time.time()
+      while time.time() - start < args.duration + 0.5:
+         i += 1
+         speed = (i % 20 - 10) / 10.0
+         transport.send(client.Cmd('drive', '{},{}'.format(speed, speed), client.EV3_CMD))
+         for dest, cmd in [(client.EV3_CMD, 'bench'), (client.ARDUINO_CMD, 'laser')]:
+            sent[dest][str(i)] = time.monotonic()
+            transport.send(client.Cmd(cmd, i, dest), coalesce=False)
+         deadline += 1.0 / args.rate
+         time.sleep(max(0, deadline - time.time()))
+
+      time.sleep(0.5)
+      wall, cpu = time.time() - start, time.process_time() - cpu
+      stats = transport.stats()
+      pings = transport.pings()
+      frameStats = frames.stats()
+      transport.stop()
+      frames.stop()
+      serverWall, serverCpu = server.stop()
+      standInsWall, standInsCpu = standIns.stop()
+      if recorder is not None:
+         recorder.close()
+
+   with open(serverReport) as f:
+      serverStats = json.load(f)
+   with open(standInsReport) as f:
+      standInsStats = json.load(f)
+   reports.cleanup()
+   arrived = {client.EV3_CMD: serverStats['arrived'], client.ARDUINO_CMD: standInsStats['arrived']}
+
+   report = {'benchmark': 'e2e',
+             'client': os.path.abspath(args.client),
+             'version': client.__version__,
+             'config': {'duration': args.duration, 'rate': args.rate, 'fps': args.fps,
+                        'camera': args.camera, 'udp': args.udp},
+             'commands': dict((dest, {'sent': len(sent[dest]),
+                                      'arrived': len(arrived[dest]),
+                                      'per_sec': len(arrived[dest]) / args.duration,
+                                      'latency_ms': percentiles([arrived[dest][key] - sent[dest][key]
+                                                                 for key in arrived[dest] if key in sent[dest]])})
+                              for dest in dests),
+             'drive': {'handled': serverStats['handled']['drive']['count'], 'udp': serverStats['motion']},
+             'rtt_ms': dict((dest, percentiles([])) for dest in dests),
+             'transport': stats,
+             'camera': {'served': standInsStats['served'],
+                        'fps_decoded': frameStats['decoded'] / wall,
+                        'fps_shown': shown[0] / wall,
+                        'pipeline': frameStats},
+             'cpu': {'wall_s': wall,
+                     'client_s': cpu, 'client_percent': cpu / wall * 100,
+                     'server_s': serverCpu, 'server_percent': serverCpu / serverWall * 100,
+                     'stand_ins_s': standInsCpu, 'stand_ins_percent': standInsCpu / standInsWall * 100}}
+   if recorder is not None:
+      report['record'] = recorder.stats()
+   for dest in dests:
+      rtt = pings[dest].rtt
+      if rtt.count:
+         report['rtt_ms'][dest] = {'count': rtt.count, 'p50': rtt.percentile(50) * 1000, 'p99': rtt.percentile(99) * 1000}
+   text = json.dumps(report, indent=1, sort_keys=True)
+   if args.output:
+      with open(args.output, 'w') as f:
+         f.write(text + '\n')
+   print(text)
+
+BENCHMARKS = {'dispatch': benchDispatch,
+              'udp': benchUdp,
+              'idle': benchIdle,
+              'protocol': benchProtocol,
+              'clients': benchClients,
+              'e2e': benchE2e,
+              'hud': benchHud,
+              'serve': serve,
+              'stand-ins': standIns}
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Curiosity rover benchmarks')
+   parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+   parser.add_argument('-n', '--count', type=int, default=10000, help='iterations per command')
+   parser.add_argument('-c', '--clients', type=int, default=20, help='simulated clients')
+   parser.add_argument('-d', '--duration', type=float, default=5, help='seconds')
+   parser.add_argument('-r', '--rate', type=float, default=50, help='controller commands per second')
+   parser.add_argument('--port', type=int, default=0, help='server port for serve, camera port for stand-ins')
+   parser.add_argument('--udp-port', type=int, help='serve: motion channel port')
+   parser.add_argument('--arduino-port', type=int, default=0, help='stand-ins: arduino port')
+   parser.add_argument('--images', help='stand-ins: folder of canned jpegs')
+   parser.add_argument('--report', help='serve, stand-ins: write JSON stats to this file on exit')
+   parser.add_argument('--loss', type=float, default=0.1, help='udp: share of dropped datagrams')
+   parser.add_argument('--delay', type=float, default=0.02, help='udp: one way delay, seconds')
+   parser.add_argument('--jitter', type=float, default=0.03, help='udp: extra random delay, seconds')
+   parser.add_argument('--fps', type=float, default=15, help='hud: camera frames per second')
+   parser.add_argument('--client', default=CLIENT_PATH, help='hud, e2e: ev3client.py to measure')
+   parser.add_argument('--camera', choices=['stream', 'snapshot'], default='stream', help='e2e: camera mode')
+   parser.add_argument('--udp', action='store_true', help='e2e: drive commands over udp')
+   parser.add_argument('-o', '--output', help='e2e: also write JSON report to this file')
+   parser.add_argument('--record', help='e2e: record the session to RECORD.seg/.idx')
+   parser.add_argument('--session', help='hud: replay this recorded session instead of synthetic input')
+   parser.add_argument('--speed', type=float, default=1.0, help='hud: replay speed')
+   parser.add_argument('--read-latency', type=float, default=0, help='simulated sysfs read, seconds')
+   parser.add_argument('--write-latency', type=float, default=0, help='simulated sysfs write, seconds')
+   args = parser.parse_args()
+   if hasattr(ev3server.ev3, 'configure'):
+      ev3server.ev3.configure({'read-latency': str(args.read_latency), 'write-latency': str(args.write_latency)})
+   BENCHMARKS[args.benchmark](args)
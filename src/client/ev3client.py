@@ -6,12 +6,27 @@ import io
 import os
 import sys
 import time
+import math
+import array
+import bisect
+import random
 import pygame
 import socket
+import struct
 import threading
+import re
 import queue
+import collections
 import select
-from urllib.request import urlopen
+import selectors
+import http.client
+from urllib.parse import urlsplit
+
+# Binary protocol module is shared with the server
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ev3server'))
+import ev3proto
+import ev3log
+import session
 
 __version__ = '0.5'
 
@@ -27,9 +42,15 @@ mr3020Cfg = config['mr3020-board']
 GATE_IP = mr3020Cfg['ip']
 GATE_PORT = int(mr3020Cfg['arduino-port'])
 EV3_PORT = int(mr3020Cfg['ev3-port'])
+EV3_UDP_PORT = int(mr3020Cfg['ev3-udp-port']) if mr3020Cfg.get('ev3-udp-port') else None
 
 frameCfg = config['camera-frame']
 CAMERA_URL_FORMAT = frameCfg['camera-url']
+CAMERA_STREAM_URL_FORMAT = frameCfg.get('stream-url', 'http://{}:{}/?action=stream')
+CAMERA_MODE = frameCfg.get('mode', 'snapshot')
+CAMERA_TIMEOUT = float(frameCfg.get('timeout', '3'))
+CAMERA_RECONNECT_SEC = float(frameCfg.get('reconnect', '1'))
+CAMERA_SNAPSHOT_FPS = float(frameCfg.get('snapshot-fps', '2'))
 FRAME_PORT = int(frameCfg['port'])
 
 FRAME_SIZE = (int(frameCfg['width']), int(frameCfg['height']))   # must be synced with web camera settings
@@ -40,29 +61,202 @@ SCREEN_SIZE = (int(windowCfg['width']), int(windowCfg['height']))
 IMG_FOLDER = windowCfg['img-path']
 
 TXT_X = FRAME_POS[0] + FRAME_SIZE[0] + 50
+SPARK_X = TXT_X + 270
 
 settingsCfg = config['settings']
 LOW_POWER = float(settingsCfg['battery-warn'])
 ALIVE_SEC = float(settingsCfg['ping-warn'])
 MIN_DISTANCE = float(settingsCfg['distance-warn'])
+STALE_SEC = float(settingsCfg.get('stale-sec', '15'))
+EV3_PROTOCOL = settingsCfg.get('protocol', 'text')
+PING_INTERVAL = float(settingsCfg.get('ping-interval', '1'))
+PING_EXPORT = settingsCfg.get('ping-export', 'rtt.csv')
+MAX_FPS = int(settingsCfg.get('max-fps', '60'))
+IDLE_FPS = float(settingsCfg.get('idle-fps', '10'))
+HISTORY_SIZE = int(settingsCfg.get('history', '600'))
+HISTORY_SEC = float(settingsCfg.get('history-sec', '60'))
+
+# Loop wakeups besides user input
+IDLE_EVENT = pygame.USEREVENT
+FRAME_EVENT = pygame.USEREVENT + 1
 
 RED = pygame.Color(settingsCfg['warn-color'])
 GREEN = pygame.Color('green')
 BLACK = pygame.Color('black')
 LIGHT_GREEN = pygame.Color(95, 190, 190)
+GREY = pygame.Color(110, 110, 110)
+
+recordCfg = config['record'] if config.has_section('record') else {}
+RECORD_PATH = recordCfg.get('path', '')
+RECORD_MAX_PENDING = int(float(recordCfg.get('max-pending', '32')) * 1024 * 1024)
+
+logCfg = config['log'] if config.has_section('log') else {}
+LOG_DUMP = logCfg.get('dump', 'ev3client.dump')
+log = ev3log.Logger(ev3log.parseLevel(logCfg.get('level', 'info')), logCfg.get('file', 'log.txt'),
+                    ring=int(logCfg.get('ring', '1000')))
+
+class MjpegStream:
+   '''mjpg-streamer "?action=stream" reader: single connection, JPEG frames are cut by SOI/EOI markers'''
+   SOI = b'\xff\xd8'
+   EOI = b'\xff\xd9'
+   ChunkSize = 16 * 1024
+   MaxBuffer = 2 * 1024 * 1024
+
+   def __init__(self, url, timeout):
+      self.url = url
+      self.timeout = timeout
+      self.__socket = None
+      self.__buffer = bytearray()
+
+   def open(self):
+      parts = urlsplit(self.url)
+      path = parts.path or '/'
+      if parts.query:
+         path += '?' + parts.query
+
+      self.__socket = socket.create_connection((parts.hostname, parts.port or 80), self.timeout)
+      self.__socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+      self.__socket.sendall('GET {} HTTP/1.0\r\nHost: {}\r\n\r\n'.format(path, parts.netloc).encode())
+
+      # Skip http response header, multipart headers are skipped by markers search
+      self.__buffer = bytearray()
+      while b'\r\n\r\n' not in self.__buffer:
+         self.__recv()
+      header, self.__buffer = self.__buffer.split(b'\r\n\r\n', 1)
+      status = header.split(b'\r\n', 1)[0].split()
+      if len(status) < 2 or status[1] != b'200':
+         raise IOError('Bad stream response: {}'.format(header.split(b'\r\n', 1)[0].decode()))
 
-def log(msg):
-   if not msg.strip():
-      return
-   with open('log.txt', 'a') as f:
-      f.write(msg)
-      f.write('\n')
+   def read(self):
+      '''Blocks until a complete frame arrives; frames already outdated by newer ones are dropped'''
+      frame = self.__extract()
+      while frame is None or self.__pending():
+         self.__recv()
+         frame = self.__extract() or frame
+      return frame
+
+   def close(self):
+      if self.__socket is not None:
+         self.__socket.close()
+         self.__socket = None
+
+   def __recv(self):
+      chunk = self.__socket.recv(self.ChunkSize)
+      if not chunk:
+         raise IOError('Stream closed')
+      self.__buffer.extend(chunk)
+      if len(self.__buffer) > self.MaxBuffer:
+         raise IOError('No frame boundary in {} bytes'.format(len(self.__buffer)))
+
+   def __pending(self):
+      r, w, x = select.select([self.__socket], [], [], 0)
+      return self.__socket in r
+
+   def __extract(self):
+      frame = None
+      while True:
+         start = self.__buffer.find(self.SOI)
+         if start < 0:
+            # Keep last byte, it may be the first half of the marker
+            del self.__buffer[:-1]
+            return frame
+
+         end = self.__buffer.find(self.EOI, start + len(self.SOI))
+         if end < 0:
+            del self.__buffer[:start]
+            return frame
+
+         end += len(self.EOI)
+         frame = bytes(self.__buffer[start:end])
+         del self.__buffer[:end]
+
+class SnapshotClient:
+   '''Fetches "?action=snapshot" frames over one persistent keep-alive connection'''
+   Retries = 1
+
+   def __init__(self, url, timeout):
+      parts = urlsplit(url)
+      self.host = parts.hostname
+      self.port = parts.port or 80
+      self.path = parts.path or '/'
+      if parts.query:
+         self.path += '?' + parts.query
+      self.timeout = timeout
+      self.__conn = None
+
+   def get(self):
+      for attempt in range(self.Retries + 1):
+         try:
+            if self.__conn is None:
+               self.__conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self.__conn.request('GET', self.path, headers={'Connection': 'keep-alive'})
+            response = self.__conn.getresponse()
+            data = response.read()
+            if response.will_close:
+               self.close()
+            if response.status != 200:
+               raise IOError('Bad snapshot response: {} {}'.format(response.status, response.reason))
+            return data
+         except (ConnectionError, http.client.BadStatusLine, http.client.ImproperConnectionState):
+            # Server closed idle keep-alive connection or pipe is broken, reconnect
+            self.close()
+            if attempt == self.Retries:
+               raise
+         except:
+            self.close()
+            raise
+
+   def close(self):
+      if self.__conn is not None:
+         self.__conn.close()
+         self.__conn = None
+
+class LatestSlot:
+   '''Single item handoff between threads: a newer put() replaces an item nobody took yet'''
+   def __init__(self):
+      self.__cond = threading.Condition()
+      self.__item = None
+      self.__full = False
+      self.dropped = 0
+
+   def put(self, item):
+      with self.__cond:
+         if self.__full:
+            self.dropped += 1
+         self.__item = item
+         self.__full = True
+         self.__cond.notify()
+
+   def get(self, timeout = None):
+      '''Waits for an item, returns None on timeout'''
+      with self.__cond:
+         if not self.__full:
+            self.__cond.wait(timeout)
+         return self.__take()
+
+   def take(self):
+      with self.__cond:
+         return self.__take()
+
+   def __take(self):
+      if not self.__full:
+         return None
+      item = self.__item
+      self.__item = None
+      self.__full = False
+      return item
 
 class WebFrame:
-   def __init__(self, ip, port):
+   '''Camera frames pipeline: fetch -> decode -> scale/convert -> show.
+      Every stage hands off through a LatestSlot, so a slow stage drops old frames instead of queueing them'''
+   StageTimeout = 0.5
+
+   def __init__(self, ip, port, notify = None, record = None):
 
       self.ip = ip
       self.port = port
+      self.__notify = notify   # called from pipeline threads when a new frame is ready
+      self.__record = record   # called with raw jpeg bytes of every fetched frame
 
       # Show noise in case of errors
       frame = pygame.image.load(os.path.join(IMG_FOLDER, 'noise.jpg'))
@@ -73,32 +267,122 @@ class WebFrame:
 
       self.__frame = self.__noiseFrame
 
-      self.started = True
-      self.__thread = threading.Thread(target=self.frameLoop)
-      self.__thread.daemon = True
-      self.__thread.start()
+      self.__fetched = LatestSlot()   # raw jpeg bytes
+      self.__decoded = LatestSlot()   # surfaces of camera size
+      self.__ready = LatestSlot()     # display ready surfaces
 
-   def __getFrame(self):
+      self.fetched = 0
+      self.decoded = 0
+      self.scaled = 0
+      self.shown = 0
+
+      self.started = True
+      self.__threads = []
+      for target in [self.frameLoop, self.__decodeLoop, self.__scaleLoop]:
+         thread = threading.Thread(target=target)
+         thread.daemon = True
+         thread.start()
+         self.__threads.append(thread)
+
+   def __getFrame(self, client):
       try:
-         frame_url = CAMERA_URL_FORMAT.format(self.ip, self.port)
-         image_str = urlopen(frame_url).read()
-         image_file = io.BytesIO(image_str)
-         frame = pygame.image.load(image_file)
-         return frame
+         return client.get()
       except:
-         pass
+         return None
 
-      # Show noise in case of errors
+   def __noise(self):
       return self.__noiseFrame if int(time.time()) % 2 == 0 else self.__noiseBlackFrame
 
+   def __putFetched(self, data):
+      self.fetched += 1
+      if self.__record is not None:
+         self.__record(data)
+      self.__fetched.put(data)
+
+   def __streamLoop(self):
+      url = CAMERA_STREAM_URL_FORMAT.format(self.ip, self.port)
+      while self.started:
+         stream = MjpegStream(url, CAMERA_TIMEOUT)
+         try:
+            stream.open()
+            while self.started:
+               self.__putFetched(stream.read())
+         except Exception as e:
+            log.warning('Camera stream: %s', e)
+         finally:
+            stream.close()
+
+         # Show noise while reconnecting
+         self.__show(self.__noise())
+         time.sleep(CAMERA_RECONNECT_SEC)
+
    def frameLoop(self):
+      if CAMERA_MODE == 'stream':
+         self.__streamLoop()
+         return
+
+      client = SnapshotClient(CAMERA_URL_FORMAT.format(self.ip, self.port), CAMERA_TIMEOUT)
+      interval = 1.0 / CAMERA_SNAPSHOT_FPS
+      while self.started:
+         deadline = time.time() + interval
+         data = self.__getFrame(client)
+         if data is None:
+            # Show noise in case of errors
+            self.__show(self.__noise())
+         else:
+            self.__putFetched(data)
+         time.sleep(max(0, deadline - time.time()))
+      client.close()
+
+   def __decodeLoop(self):
       while self.started:
-         self.__frame = self.__getFrame()
-         time.sleep(0.5)
+         data = self.__fetched.get(self.StageTimeout)
+         if data is None:
+            continue
+         try:
+            frame = pygame.image.load(io.BytesIO(data))
+         except pygame.error:
+            # Corrupted frame, wait for the next one
+            continue
+         self.decoded += 1
+         self.__decoded.put(frame)
+
+   def __scaleLoop(self):
+      while self.started:
+         frame = self.__decoded.get(self.StageTimeout)
+         if frame is None:
+            continue
+         if frame.get_size() != FRAME_SIZE:
+            frame = pygame.transform.scale(frame, FRAME_SIZE)
+         try:
+            frame = frame.convert()
+         except pygame.error:
+            # No display mode set yet
+            pass
+         self.scaled += 1
+         self.__show(frame)
+
+   def __show(self, frame):
+      self.__ready.put(frame)
+      if self.__notify is not None:
+         self.__notify()
 
    def getFrame(self):
+      frame = self.__ready.take()
+      if frame is not None:
+         self.shown += 1
+         self.__frame = frame
       return self.__frame
 
+   def stats(self):
+      return {'fetched': self.fetched,
+              'decoded': self.decoded,
+              'scaled': self.scaled,
+              'shown': self.shown,
+              'dropped-fetched': self.__fetched.dropped,
+              'dropped-decoded': self.__decoded.dropped,
+              'dropped-ready': self.__ready.dropped}
+
    def stop(self):
       self.started = False
       #self.__thread.join()
@@ -123,98 +407,649 @@ class Cmd:
    def __eq__(self, c):
       return (self.cmd == c.cmd) and (self.value == c.value)
 
-class CmdTransport:
-   def __init__(self, ip, port, ev3port):
+class CmdQueue:
+   '''Commands FIFO. State setting commands keep one slot per (dest, cmd):
+      a newer value replaces the queued one in place instead of being sent after it'''
+   Coalesced = {'drive', 'xy', 'turn', 'arm1', 'arm2', 'cam', 'gear', 'laser'}
+
+   def __init__(self):
+      self.__lock = threading.Lock()
+      self.__items = collections.deque()   # [key, cmd], key is None for FIFO only commands
+      self.__slots = {}
+      self.coalesced = 0
+
+   def put(self, cmd, coalesce = True):
+      key = None
+      if coalesce and str(cmd.cmd).lower() in self.Coalesced:
+         key = (cmd.dest, cmd.cmd)
+
+      with self.__lock:
+         item = self.__slots.get(key)
+         if item is not None:
+            item[1] = cmd
+            self.coalesced += 1
+            return
+
+         item = [key, cmd]
+         self.__items.append(item)
+         if key is not None:
+            self.__slots[key] = item
+
+   def takeAll(self):
+      with self.__lock:
+         cmds = [item[1] for item in self.__items]
+         self.__items.clear()
+         self.__slots.clear()
+      return cmds
+
+   def __len__(self):
+      return len(self.__items)
+
+class Histogram:
+   '''Log scale histogram of seconds, bucket bounds grow by Ratio, so percentiles are accurate to ~10%'''
+   MinValue = 0.0001
+   Ratio = 1.1
+   Buckets = 128   # up to ~20 s, larger values go to the last bucket
+
+   def __init__(self):
+      self.counts = [0] * (self.Buckets + 1)
+      self.count = 0
+      self.total = 0
+      self.max = 0
+
+   def add(self, value):
+      i = 0 if value <= self.MinValue else min(self.Buckets, int(math.log(value / self.MinValue, self.Ratio)) + 1)
+      self.counts[i] += 1
+      self.count += 1
+      self.total += value
+      self.max = max(self.max, value)
+
+   def bound(self, i):
+      return self.MinValue * self.Ratio ** i
+
+   def percentile(self, p):
+      '''Upper bound of the bucket holding p-th percentile, None if empty'''
+      if not self.count:
+         return None
+      rank = p / 100.0 * self.count
+      seen = 0
+      for i, count in enumerate(self.counts):
+         seen += count
+         if count and seen >= rank:
+            return min(self.bound(i), self.max)
+      return self.max
+
+class History:
+   '''Last size samples with monotonic stamps in array rings: memory stays the same however long
+      the session runs, summaries and downsampling work on array slices'''
+   def __init__(self, size = None):
+      self.size = size or HISTORY_SIZE
+      self.values = array.array('f', [0.0]) * self.size
+      self.stamps = array.array('d', [0.0]) * self.size
+      self.count = 0   # samples ever added, a reader can tell the history changed
+
+   def add(self, value, stamp = None):
+      i = self.count % self.size
+      self.values[i] = value
+      self.stamps[i] = time.monotonic() if stamp is None else stamp
+      self.count += 1
+
+   def __len__(self):
+      return min(self.count, self.size)
+
+   def ordered(self):
+      '''(values, stamps) oldest first'''
+      count = self.count
+      if count <= self.size:
+         return self.values[:count], self.stamps[:count]
+      i = count % self.size
+      return self.values[i:] + self.values[:i], self.stamps[i:] + self.stamps[:i]
+
+   def since(self, start):
+      values, stamps = self.ordered()
+      i = bisect.bisect_left(stamps, start)
+      return values[i:], stamps[i:]
+
+   def summary(self, start = 0):
+      '''(min, avg, max) of samples since start, None if there are none'''
+      values = self.since(start)[0]
+      if not values:
+         return None
+      return min(values), sum(values) / len(values), max(values)
+
+   def downsample(self, start, end, buckets):
+      '''(min, max) per equal time bucket from start to end, None for a bucket without samples'''
+      values, stamps = self.since(start)
+      step = (end - start) / buckets
+      result = []
+      lo = 0
+      for b in range(buckets):
+         hi = len(stamps) if b == buckets - 1 else bisect.bisect_left(stamps, start + (b + 1) * step, lo)
+         chunk = values[lo:hi]
+         result.append((min(chunk), max(chunk)) if chunk else None)
+         lo = hi
+      return result
+
+class PingStats:
+   '''Echo pings of one destination: 'ping:seq,stamp;' comes back as is, stamp is client monotonic ms.
+      Payload fits the 16 chars value buffer of the arduino sketch'''
+   SeqWrap = 10000
+   StampWrap = 1 << 24   # ~4.6 hours
+
+   def __init__(self):
+      self.rtt = Histogram()
+      self.jitter = Histogram()   # difference of consecutive round trips
+      self.history = History()    # rtt, ms
+      self.sent = 0
+      self.received = 0
+      self.__seq = 0
+      self.__lastSeq = None
+      self.__lastRtt = None
+
+   def next(self):
+      self.__seq = (self.__seq + 1) % self.SeqWrap
+      self.sent += 1
+      return Cmd('ping', '{},{}'.format(self.__seq, int(time.monotonic() * 1000) % self.StampWrap))
+
+   def echo(self, seq, stamp):
+      if seq == self.__lastSeq:
+         # Duplicate
+         return
+      self.__lastSeq = seq
+      rtt = ((int(time.monotonic() * 1000) - stamp) % self.StampWrap) / 1000.0
+      self.received += 1
+      self.rtt.add(rtt)
+      self.history.add(rtt * 1000)
+      if self.__lastRtt is not None:
+         self.jitter.add(abs(rtt - self.__lastRtt))
+      self.__lastRtt = rtt
+
+   def export(self, f, dest):
+      '''CSV rows: dest,metric,bucket upper bound ms,count'''
+      for metric, histogram in [('rtt', self.rtt), ('jitter', self.jitter)]:
+         for i, count in enumerate(histogram.counts):
+            if count:
+               f.write('{},{},{:.3f},{}\n'.format(dest, metric, histogram.bound(i) * 1000, count))
+
+class CmdWriter:
+   '''Connection to a single destination with its own thread, queue and socket.
+      The thread sleeps in a selector until a command is queued or the socket has data to read,
+      then packs all pending commands into one sendall'''
+   RecvSize = 4096
+   MaxTail = 4096
+   ConnectTimeout = 3
+   ReconnectSec = 10
+   PingEcho = re.compile(r'ping:(\d+),(\d+);')
+
+   def __init__(self, name, ip, port, in_queue, binary = False, greeting = None, recorder = None):
+      self.name = name
       self.ip = ip
       self.port = port
-      self.ev3port = ev3port
-      self.__queue = queue.Queue()
-      self.in_queue = queue.Queue()
+      self.in_queue = in_queue
+      self.binary = binary      # ask for binary protocol after connect
+      self.greeting = greeting or []   # text frames sent after every connect
+      self.udpOffered = False   # server accepted udp motion token
+      self.udpReady = False     # server got a probe datagram, so udp reaches it
+      self.recorder = recorder  # session.Recorder of received frames
+      self.__queue = CmdQueue()
       self.__socket = None
-      #self.__prevCmd = None
-
-      self.__lastReconnect = None
+      self.__binary = False     # server agreed to binary protocol
+      self.__tail = b''
+      self.__lastReconnect = 0
+      self.__reconnect = False
+
+      self.sent = 0
+      self.batches = 0
+      self.dropped = 0
+      self.pings = PingStats()
+
+      # send() writes a byte here to wake the selector up
+      self.__wakeRecv, self.__wakeSend = socket.socketpair()
+      self.__wakeRecv.setblocking(False)
+      self.__wakeSend.setblocking(False)
+      self.__selector = selectors.DefaultSelector()
+      self.__selector.register(self.__wakeRecv, selectors.EVENT_READ)
 
       self.started = True
       self.__thread = threading.Thread(target=self.__processLoop)
       self.__thread.daemon = True
       self.__thread.start()
 
-      self.__pingThread = threading.Thread(target=self.__pingThread)
-      self.__pingThread.daemon = True
-      self.__pingThread.start()
+   def isConnected(self):
+      return self.__socket is not None
 
-   def __pingThread(self):
-      while self.started:
-         ping = Cmd('ping', 'ping', EV3_CMD);
-         self.send(ping)
-         time.sleep(ALIVE_SEC - 1)
+   def send(self, cmd, coalesce = True):
+      self.__queue.put(cmd, coalesce)
+      self.__wake()
 
-   def isReady(self):
-      return self.__socket is not None
+   def ping(self):
+      if self.isConnected():
+         self.send(self.pings.next(), coalesce=False)
 
-   def send(self, cmd):
-      #if cmd == self.__prevCmd:
-      #   return
-      self.__queue.put_nowait(cmd)
-      #self.__prevCmd = cmd
+   def reconnect(self):
+      if time.time() - self.__lastReconnect > self.ReconnectSec:
+         # Socket is owned by process loop thread
+         self.__lastReconnect = time.time()
+         self.__reconnect = True
+         self.__wake()
 
-   def reconnectEv3(self):
-      if time.time() - self.__lastReconnect > 10:
-         print('reconnection..')
-         self.__ev3socket = self.__connect(self.ev3port)
+   def stats(self):
+      return {'sent': self.sent,
+              'batches': self.batches,
+              'dropped': self.dropped,
+              'pending': len(self.__queue),
+              'coalesced': self.__queue.coalesced}
 
-   def __processLoop(self):
-      self.__socket = self.__connect(self.port)
-      self.__ev3socket = self.__connect(self.ev3port)
+   def __wake(self):
+      try:
+         self.__wakeSend.send(b'\0')
+      except OSError:
+         # Wake up buffer is full, selector is going to wake up anyway
+         pass
+
+   def __drop(self):
       if self.__socket is None:
          return
+      self.__selector.unregister(self.__socket)
+      self.__socket.close()
+      self.__socket = None
+      self.__binary = False
+      self.udpOffered = False
+      self.udpReady = False
+      self.__tail = b''
+
+   def __processLoop(self):
+      self.__connect()
       while self.started:
          try:
-            cmd = self.__queue.get_nowait()
-            cmds = str(cmd)
-
-            if cmd.dest is None or cmd.dest == ARDUINO_CMD:
-               r, w, x = select.select([self.__socket], [self.__socket], [], 1)
-               if self.__socket in r:
-                  data = self.__socket.recv(128).decode()
-                  self.in_queue.put(data)
-               if self.__socket in w:
-                  print('senging to ardu:', cmds)
-                  self.__socket.sendall(cmds.encode())
-                  time.sleep(0.1)
-
-            if cmd.dest is None or cmd.dest == EV3_CMD:
-               r, w, x = select.select([self.__ev3socket], [self.__ev3socket], [self.__ev3socket], 1)
-               if self.__ev3socket in r:
-                  data = self.__ev3socket.recv(128).decode()
-                  self.in_queue.put(data)
-               if self.__ev3socket in w:
-                  print('senging to ev3:', cmds)
-                  self.__ev3socket.sendall(cmds.encode())
-                  time.sleep(0.1)
-         except queue.Empty:
-            pass
+            timeout = None
+            if self.__socket is None:
+               timeout = max(0, self.__lastReconnect + self.ReconnectSec - time.time())
+
+            for key, events in self.__selector.select(timeout):
+               if key.fileobj is self.__wakeRecv:
+                  while True:
+                     try:
+                        if not self.__wakeRecv.recv(self.RecvSize):
+                           break
+                     except BlockingIOError:
+                        break
+               else:
+                  self.__read()
+
+            if self.__reconnect or (self.__socket is None and time.time() - self.__lastReconnect >= self.ReconnectSec):
+               self.__reconnect = False
+               log.info('%s: reconnection..', self.name)
+               self.__drop()
+               self.__connect()
+
+            self.__flush()
          except Exception as e:
-            print(e)
+            log.exception('%s: %s', self.name, e)
 
-   def __connect(self, port):
+   def __read(self):
+      data = self.__socket.recv(self.RecvSize)
+      if not data:
+         log.warning('Connection closed by %s', self.name)
+         self.__drop()
+         return
+
+      # Only complete 'cmd:value;' frames go to the in_queue
+      data = self.__tail + data
+      end = data.rfind(b';') + 1
+      self.__tail = data[end:] if len(data) - end < self.MaxTail else b''
+      if end:
+         frames = data[:end].decode('utf-8', 'replace')
+         if self.recorder is not None:
+            self.recorder.received(self.name, frames)
+         if 'proto:{};'.format(ev3proto.VERSION) in frames:
+            self.__binary = True
+         if re.search(r'(^|;)udp:\d+;', frames):
+            self.udpOffered = True
+         if re.search(r'(^|;)udp:ok;', frames):
+            self.udpReady = True
+         if 'ping:' in frames:
+            # Echoes are measured here, reading thread does not wait for the render loop
+            for seq, stamp in self.PingEcho.findall(frames):
+               self.pings.echo(int(seq), int(stamp))
+            frames = self.PingEcho.sub('', frames)
+         if frames:
+            self.in_queue.put(frames)
+
+   def __flush(self):
+      cmds = self.__queue.takeAll()
+      if not cmds:
+         return
+      if self.__socket is None:
+         self.dropped += len(cmds)
+         return
+
+      if self.__binary:
+         frames = b''.join(self.__encode(cmd) for cmd in cmds)
+      else:
+         frames = ''.join(str(cmd) for cmd in cmds).encode()
+      log.debug('sending to %s: %s', self.name, cmds)
       try:
-         self.__lastReconnect = time.time()
+         self.__socket.sendall(frames)
+         self.sent += len(cmds)
+         self.batches += 1
+      except OSError as e:
+         log.warning('%s: %s', self.name, e)
+         self.__drop()
+
+   def __encode(self, cmd):
+      '''Binary frame, a value that does not fit the binary layout goes as TEXT and fails on the server alone'''
+      try:
+         return ev3proto.encode(cmd.cmd, cmd.value)
+      except (ValueError, TypeError, struct.error) as e:
+         log.warning('%s: %s as text: %s', self.name, cmd, e)
+         return ev3proto.encodeText(cmd.cmd, cmd.value)
 
-         print('Connecting to {}:{}', self.ip, port)
+   def __connect(self):
+      self.__lastReconnect = time.time()
+      try:
+         log.info('Connecting to %s:%s', self.ip, self.port)
          s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
          s.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-         s.connect((self.ip, port))
-         return s
+         s.settimeout(self.ConnectTimeout)
+         s.connect((self.ip, self.port))
+         s.settimeout(None)
+         greeting = list(self.greeting)
+         if self.binary:
+            # Text is used until server confirms
+            greeting.append('proto:{};'.format(ev3proto.VERSION))
+         if greeting:
+            s.sendall(''.join(greeting).encode())
+         self.__selector.register(s, selectors.EVENT_READ)
+         self.__socket = s
       except Exception as e:
-         print(e)
-         return None
+         log.warning('%s: %s', self.name, e)
 
    def stop(self):
       self.started = False
+      self.__wake()
       #self.__thread.join()
 
+class MotionChannel:
+   '''drive/xy setpoints as UDP datagrams with a sequence number, server applies only the newest one.
+      The last setpoint is repeated a few times, so a single lost datagram does not leave the rover driving'''
+   RepeatSec = 0.1
+   RepeatCount = 5
+
+   def __init__(self, ip, port):
+      self.addr = (ip, port)
+      self.token = random.getrandbits(32)
+      self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self.__seq = 0
+      self.__last = None
+      self.__repeats = 0
+      self.__deadline = 0   # monotonic time of the next repeat
+      self.__cond = threading.Condition()
+      self.sent = 0
+      self.errors = 0
+
+      self.started = True
+      self.__thread = threading.Thread(target=self.__repeatLoop)
+      self.__thread.daemon = True
+      self.__thread.start()
+
+   def send(self, cmd):
+      with self.__cond:
+         self.__last = cmd
+         self.__repeats = self.RepeatCount
+         self.__deadline = time.monotonic() + self.RepeatSec
+         self.__send(cmd)
+         self.__cond.notify()
+
+   def probe(self):
+      '''Sequence number 0 is never applied, server answers udp:ok over tcp'''
+      with self.__cond:
+         self.__sendto(0, 'drive', '0,0')
+
+   def __send(self, cmd):
+      self.__seq += 1
+      self.__sendto(self.__seq, cmd.cmd, cmd.value)
+
+   def __sendto(self, seq, cmd, value):
+      try:
+         self.__socket.sendto(ev3proto.encodeMotion(self.token, seq, time.monotonic(), cmd, value), self.addr)
+         self.sent += 1
+      except (OSError, ValueError) as e:
+         self.errors += 1
+         log.warning('udp: %s', e)
+
+   def __repeatLoop(self):
+      while self.started:
+         with self.__cond:
+            while self.started and not self.__repeats:
+               self.__cond.wait()
+            delay = self.__deadline - time.monotonic()
+            if delay > 0:
+               # A new setpoint moves the deadline, it is checked again after any wakeup
+               self.__cond.wait(delay)
+               continue
+            if self.__repeats:
+               self.__repeats -= 1
+               self.__deadline = time.monotonic() + self.RepeatSec
+               self.__send(self.__last)
+
+   def stats(self):
+      return {'sent': self.sent, 'errors': self.errors}
+
+   def stop(self):
+      self.started = False
+      with self.__cond:
+         self.__cond.notify()
+
+class CmdTransport:
+   '''Routes commands to independent arduino and ev3 writers, so a dead link does not hold up the other'''
+   def __init__(self, ip, port, ev3port, recorder = None):
+      self.ip = ip
+      self.port = port
+      self.ev3port = ev3port
+      self.in_queue = queue.Queue()
+
+      self.__motion = None
+      greeting = []
+      if EV3_UDP_PORT is not None:
+         self.__motion = MotionChannel(ip, EV3_UDP_PORT)
+         greeting.append('udp:{};'.format(self.__motion.token))
+
+      self.recorder = recorder
+      self.__writers = {ARDUINO_CMD: CmdWriter(ARDUINO_CMD, ip, port, self.in_queue, recorder=recorder),
+                        EV3_CMD: CmdWriter(EV3_CMD, ip, ev3port, self.in_queue, EV3_PROTOCOL == 'binary', greeting, recorder)}
+
+      self.started = True
+      self.__pingThread = threading.Thread(target=self.__pingThread)
+      self.__pingThread.daemon = True
+      self.__pingThread.start()
+
+   def __pingThread(self):
+      while self.started:
+         for writer in self.__writers.values():
+            writer.ping()
+         writer = self.__writers[EV3_CMD]
+         if self.__motion is not None and writer.udpOffered and not writer.udpReady:
+            self.__motion.probe()
+         time.sleep(PING_INTERVAL)
+
+   def pings(self):
+      '''Destination -> PingStats'''
+      return dict((dest, writer.pings) for dest, writer in self.__writers.items())
+
+   def exportPings(self, path):
+      with open(path, 'w') as f:
+         f.write('dest,metric,le_ms,count\n')
+         for dest, pings in sorted(self.pings().items()):
+            pings.export(f, dest)
+
+   def isReady(self):
+      return self.__writers[ARDUINO_CMD].isConnected()
+
+   def send(self, cmd, coalesce = True):
+      '''Queues command, not yet sent value of the same state command is replaced unless coalesce is False'''
+      for dest, writer in self.__writers.items():
+         if cmd.dest is None or cmd.dest == dest:
+            if self.recorder is not None:
+               self.recorder.sent(dest, cmd)
+            if dest == EV3_CMD and cmd.cmd in ev3proto.MOTION_CMDS and self.__motion is not None and writer.udpReady:
+               self.__motion.send(cmd)
+            else:
+               writer.send(cmd, coalesce)
+
+   def stats(self):
+      stats = dict((dest, writer.stats()) for dest, writer in self.__writers.items())
+      if self.__motion is not None:
+         stats['motion'] = self.__motion.stats()
+      return stats
+
+   def reconnectEv3(self):
+      self.__writers[EV3_CMD].reconnect()
+
+   def stop(self):
+      self.started = False
+      for writer in self.__writers.values():
+         writer.stop()
+      if self.__motion is not None:
+         self.__motion.stop()
+
+class Replay:
+   '''Recorded session played instead of the robot, stands in for both WebFrame and CmdTransport.
+      Records are read through the memory mapped index as playback reaches them, seek is a binary search'''
+   SeekSec = 10
+   MaxLag = 0.2   # frames due longer ago are skipped, not decoded
+
+   def __init__(self, path, speed = 1.0, start = 0.0, loop = False):
+      self.session = session.Session(path)
+      self.meta = self.session.meta()   # wall, version, frame-size of the recording client
+      self.speed = speed
+      self.loop = loop
+      self.in_queue = queue.Queue()
+      self.__notify = None
+
+      frame = pygame.image.load(os.path.join(IMG_FOLDER, 'noise_black.jpg'))
+      self.__frame = pygame.transform.scale(frame, FRAME_SIZE)
+      self.__ready = LatestSlot()
+      self.__seeks = LatestSlot()   # session stamps to jump to
+      self.__wake = threading.Event()
+      self.__pings = {ARDUINO_CMD: PingStats(), EV3_CMD: PingStats()}
+
+      self.position = self.session.start()
+      self.frames = 0
+      self.skipped = 0
+      self.messages = 0
+      self.sent = 0
+      self.shown = 0
+
+      self.started = False
+      self.seek(start)
+
+   def play(self, notify = None):
+      self.__notify = notify
+      self.started = True
+      self.__thread = threading.Thread(target=self.__playLoop)
+      self.__thread.daemon = True
+      self.__thread.start()
+
+   def seek(self, offset):
+      '''Jumps to offset seconds from the session start'''
+      self.__seeks.put(self.session.start() + max(0.0, offset))
+      self.__wake.set()
+
+   def skip(self, sec):
+      self.seek(self.elapsed() + sec)
+
+   def elapsed(self):
+      return self.position - self.session.start()
+
+   def duration(self):
+      return self.session.end() - self.session.start()
+
+   def __playLoop(self):
+      count = len(self.session)
+      while self.started:
+         self.__wake.clear()
+         target = self.__seeks.take()
+         if target is None:
+            # Played to the end, wait for a seek
+            self.__wake.wait()
+            continue
+
+         i = self.session.seek(target)
+         start = time.monotonic()
+         while self.started and not self.__wake.is_set() and i < count:
+            stamp, offset, length, kind = self.session.entry(i)
+            delay = (stamp - target) / self.speed - (time.monotonic() - start)
+            if delay > 0 and self.__wake.wait(delay):
+               break
+            self.position = stamp
+            if kind == session.FRAME and delay < -self.MaxLag:
+               # Skipped before payload() touches the segment, a late frame is never paged in
+               self.skipped += 1
+            elif kind in [session.FRAME, session.RECEIVED]:
+               self.__play(kind, self.session.payload(i))
+            i += 1
+
+         if i >= count and self.loop:
+            self.seek(0)
+
+   def __play(self, kind, payload):
+      if kind == session.FRAME:
+         try:
+            frame = pygame.image.load(io.BytesIO(payload))
+         except pygame.error:
+            return
+         if frame.get_size() != FRAME_SIZE:
+            frame = pygame.transform.scale(frame, FRAME_SIZE)
+         try:
+            frame = frame.convert()
+         except pygame.error:
+            pass
+         self.frames += 1
+         self.__ready.put(frame)
+         if self.__notify is not None:
+            self.__notify()
+      elif kind == session.RECEIVED:
+         dest, data = payload.decode('utf-8', 'replace').split(' ', 1)
+         self.messages += 1
+         self.in_queue.put(data)
+
+   def getFrame(self):
+      frame = self.__ready.take()
+      if frame is not None:
+         self.shown += 1
+         self.__frame = frame
+      return self.__frame
+
+   def isReady(self):
+      return True
+
+   def send(self, cmd, coalesce = True):
+      # Nothing is connected, recorded commands are not played either
+      self.sent += 1
+
+   def pings(self):
+      return self.__pings
+
+   def exportPings(self, path):
+      # Rtt of a replay means nothing, the export of a real session is kept
+      pass
+
+   def reconnectEv3(self):
+      pass
+
+   def stats(self):
+      return {'records': len(self.session), 'frames': self.frames, 'skipped': self.skipped,
+              'messages': self.messages, 'sent': self.sent, 'shown': self.shown,
+              'dropped-ready': self.__ready.dropped}
+
+   def stop(self):
+      if self.started:
+         self.started = False
+         self.__wake.set()
+         self.__thread.join()
+      self.session.close()
+
 class Joystick:
    def __init__(self):
       self.__joystick = None
@@ -269,12 +1104,136 @@ class Joystick:
                data.append(Cmd('get', 'out'))
       return data
 
+def sample(value):
+   '''"value,stamp" sensor sample -> (value, server monotonic stamp), older servers send value only'''
+   value, _, stamp = value.partition(',')
+   try:
+      return value, float(stamp)
+   except ValueError:
+      return value, None
+
 def sumd(e1, e2):
    return [e1[i] + e2[i] for i in range(len(e1))]
 
-def text_objects(text, font):
-   textSurface = font.render(text, True, BLACK)
-   return textSurface, textSurface.get_rect()
+class TextCache:
+   '''Rendered text surfaces by (font, text, color, antialias), least recently used ones are evicted'''
+   def __init__(self, size = 128):
+      self.__size = size
+      self.__items = collections.OrderedDict()
+      self.hits = 0
+      self.misses = 0
+
+   def render(self, font, text, antialias, color):
+      key = (font, text, tuple(color), antialias)
+      surface = self.__items.get(key)
+      if surface is not None:
+         self.hits += 1
+         self.__items.move_to_end(key)
+         return surface
+
+      self.misses += 1
+      surface = font.render(text, antialias, color)
+      self.__items[key] = surface
+      if len(self.__items) > self.__size:
+         self.__items.popitem(last=False)
+      return surface
+
+   def stats(self):
+      return {'hits': self.hits, 'misses': self.misses, 'size': len(self.__items)}
+
+class Widget:
+   '''Retained HUD element, its screen area is repainted only when its surface or position changes'''
+   def __init__(self):
+      self.__surface = None
+      self.__pos = None
+      self.__rect = None
+      self.dirty = False
+
+   def show(self, surface, pos):
+      if surface is self.__surface and pos == self.__pos:
+         return
+      self.__surface = surface
+      self.__pos = pos
+      self.dirty = True
+
+   def hide(self):
+      self.show(None, None)
+
+   def invalidate(self):
+      '''Screen was repainted, next draw() blits the surface again'''
+      self.__rect = None
+      self.dirty = True
+
+   def areas(self):
+      '''Screen rects touched by the next draw()'''
+      rects = [] if self.__rect is None else [self.__rect]
+      if self.__surface is not None:
+         rects.append(self.__surface.get_rect(topleft=self.__pos))
+      return rects
+
+   def overlaps(self, rects):
+      return self.__rect is not None and self.__rect.collidelist(rects) != -1
+
+   def draw(self, screen, background):
+      '''Restores background under the old area, blits the surface, returns changed rects'''
+      if not self.dirty:
+         return []
+      self.dirty = False
+
+      rects = []
+      if self.__rect is not None:
+         screen.blit(background, self.__rect, self.__rect)
+         rects.append(self.__rect)
+      self.__rect = None
+      if self.__surface is not None:
+         self.__rect = screen.blit(self.__surface, self.__pos)
+         rects.append(self.__rect)
+      return rects
+
+class Sparkline:
+   '''Min/max envelope of a History over the last HISTORY_SEC, with min/avg/max under it.
+      Surface is rendered again when the history got new samples or the window moved by a column,
+      it is gone once no samples are left in the window'''
+   Size = (180, 46)
+   PlotHeight = 30
+
+   def __init__(self, history, font, fmt, color):
+      self.history = history
+      self.__font = font
+      self.__fmt = fmt   # of a single value
+      self.__color = color
+      self.__key = None
+      self.__surface = None
+
+   def render(self):
+      width, height = self.Size
+      now = time.monotonic()
+      key = (self.history.count, int(now * width / HISTORY_SEC))
+      if key == self.__key:
+         return self.__surface
+      self.__key = key
+
+      start = now - HISTORY_SEC
+      summary = self.history.summary(start)
+      if summary is None:
+         self.__surface = None
+         return None
+      low, avg, high = summary
+      span = (high - low) or 1.0
+
+      surface = pygame.Surface(self.Size, pygame.SRCALPHA)
+      bottom = self.PlotHeight - 1
+      for x, bucket in enumerate(self.history.downsample(start, now, width)):
+         if bucket is not None:
+            y1 = bottom - int((bucket[1] - low) / span * bottom)
+            y2 = bottom - int((bucket[0] - low) / span * bottom)
+            pygame.draw.line(surface, self.__color, (x, y1), (x, y2))
+
+      fmt = self.__fmt
+      txt = 'min {} avg {} max {}'.format(fmt.format(low), fmt.format(avg), fmt.format(high))
+      surface.blit(self.__font.render(txt, True, self.__color), (0, self.PlotHeight + 1))
+      self.__surface = surface
+      return surface
 
 class RoboControl:
    def __init__(self):
@@ -283,24 +1242,63 @@ class RoboControl:
 
       self.__webFrame = None
       self.__cmdTransport = None
+      self.__recorder = None
+      self.__replay = None
       self.__joystick = None
       self.__screen = None
       self.__clock = pygame.time.Clock()
       self.__font = pygame.font.SysFont('Arial', 25)
+      self.__smallFont = pygame.font.SysFont('Arial', 13)
+      self.__buttonFont = pygame.font.SysFont('comicsansms', 20)
+      self.__text = TextCache()
+      self.__widgets = collections.OrderedDict()   # drawn in creation order
+      self.__buttons = {}
+      self.__camViewAngle = None
+      self.__camViewRotated = None
+      self.wakeups = 0
+      self.updates = 0
       self.__last_ir_value= 0
+      self.__last_ir_stamp = None   # local monotonic time the value was sampled
       self.__last_ping_time = 0
       self.__last_power_value = 0
+      self.__last_power_stamp = None
+      self.__irHistory = History()
+      self.__powerHistory = History()
+      self.__sparklines = {}
+      self.__server_time = None
+      self.__telemetry_seq = 0
+      self.__telemetry_lost = 0
 
       frame = pygame.image.load(os.path.join(IMG_FOLDER, 'cam.png'))
       self.__camViewFrame = pygame.transform.scale(frame, (100, 100))
 
       self.__gear = 1
 
-   def run(self, joystick = Joystick):
+   def run(self, joystick = Joystick, replay = None):
+      '''replay: Replay to play instead of connecting to the robot'''
       self.__initScreen()
       #self.__joystick = joystick()
-      self.__webFrame = WebFrame(GATE_IP, FRAME_PORT)
-      self.__cmdTransport = CmdTransport(GATE_IP, GATE_PORT, EV3_PORT)
+      record = None
+      if replay is not None:
+         self.__replay = replay
+         self.__webFrame = self.__cmdTransport = replay
+         replay.play(notify=self.__onFrame)
+         meta = replay.meta
+         recorded = time.strftime('%Y-%m-%d %H:%M', time.localtime(meta['wall'])) if 'wall' in meta else '?'
+         pygame.display.set_caption('Legowrt v.{} replay {} recorded {}'.format(__version__, replay.session.path, recorded))
+         log.info('replaying %s, %s records, %.1fs, recorded %s by v.%s', replay.session.path, len(replay.session),
+                  replay.duration(), recorded, meta.get('version', '?'))
+         if meta.get('frame-size') and tuple(meta['frame-size']) != FRAME_SIZE:
+            log.info('recorded frame size %s, frames are scaled to %s', tuple(meta['frame-size']), FRAME_SIZE)
+      elif RECORD_PATH:
+         os.makedirs(RECORD_PATH, exist_ok=True)
+         path = os.path.join(RECORD_PATH, time.strftime('session-%Y%m%d-%H%M%S'))
+         self.__recorder = session.Recorder(path, {'version': __version__, 'frame-size': FRAME_SIZE}, RECORD_MAX_PENDING)
+         record = self.__recorder.frame
+         log.info('recording to %s', path)
+      if replay is None:
+         self.__webFrame = WebFrame(GATE_IP, FRAME_PORT, notify=self.__onFrame, record=record)
+         self.__cmdTransport = CmdTransport(GATE_IP, GATE_PORT, EV3_PORT, self.__recorder)
 
       self.__arm1 = 100
       cmd = Cmd('Arm1', self.__arm1)
@@ -322,9 +1320,42 @@ class RoboControl:
 
       self.__loop()
 
+   def __widget(self, key):
+      widget = self.__widgets.get(key)
+      if widget is None:
+         widget = self.__widgets[key] = Widget()
+      return widget
+
    def __txtRow(self, render, row):
       hrow = 50
-      self.__screen.blit(render, (TXT_X, FRAME_POS[1] + hrow * (row - 1)))
+      self.__widget(('row', row)).show(render, (TXT_X, FRAME_POS[1] + hrow * (row - 1)))
+
+   def __draw(self):
+      '''Draws dirty widgets, returns screen rects to update'''
+      widgets = list(self.__widgets.values())
+      areas = [rect for widget in widgets if widget.dirty for rect in widget.areas()]
+
+      # Restored background must not wipe overlapping widgets, they are drawn again
+      changed = True
+      while changed:
+         changed = False
+         for widget in widgets:
+            if not widget.dirty and widget.overlaps(areas):
+               widget.dirty = True
+               areas += widget.areas()
+               changed = True
+
+      rects = []
+      for widget in widgets:
+         rects += widget.draw(self.__screen, self.__bkgnd_img)
+      return rects
+
+   def __onFrame(self):
+      try:
+         pygame.event.post(pygame.event.Event(FRAME_EVENT))
+      except pygame.error:
+         # Event queue is full, loop is awake anyway
+         pass
 
    def __initScreen(self):
       self.__screen = pygame.display.set_mode(SCREEN_SIZE)
@@ -333,62 +1364,132 @@ class RoboControl:
       ico = pygame.image.load(os.path.join(IMG_FOLDER, 'icon.jpg'))
       pygame.display.set_icon(ico)
 
-      self.__bkgnd_img = pygame.image.load(os.path.join(IMG_FOLDER, 'frame.jpg'))
+      self.__bkgnd_img = pygame.image.load(os.path.join(IMG_FOLDER, 'frame.jpg')).convert()
+
+   def __redraw(self):
+      '''Full repaint, on start and when the window was exposed'''
+      self.__screen.blit(self.__bkgnd_img, (0, 0))
+      for widget in self.__widgets.values():
+         widget.invalidate()
 
    def __dispatchResponse(self):
+      handlers = {'ir': self.onIR, 'ping': self.onPing, 'power': self.onPower}
       while not self.__cmdTransport.in_queue.empty():
          data = self.__cmdTransport.in_queue.get_nowait()
          for raw_cmd in data.split(';'):
             cmd = Cmd.parse(raw_cmd)
-            if cmd.cmd == 'ir':
-               self.onIR(cmd)
-            elif cmd.cmd == 'ping':
-               self.onPing(cmd)
-            elif cmd.cmd == 'power':
-               self.onPower(cmd)
-
-   def onPing(self, cmd):
+            if cmd.cmd == 'tm':
+               self.__onTelemetryFrame(cmd.value, handlers)
+            elif cmd.cmd in handlers:
+               # Older servers send a message per value
+               handlers[cmd.cmd](*sample(cmd.value))
+
+   def __onTelemetryFrame(self, value, handlers):
+      '''tm:seq,time,name=value@stamp,...'''
+      fields = value.split(',')
+      try:
+         seq = int(fields[0])
+         self.__server_time = float(fields[1])
+      except (IndexError, ValueError):
+         return
+      if self.__telemetry_seq and seq > self.__telemetry_seq + 1:
+         self.__telemetry_lost += seq - self.__telemetry_seq - 1
+      self.__telemetry_seq = seq
+
+      for item in fields[2:]:
+         name, _, val = item.partition('=')
+         val, _, stamp = val.partition('@')
+         if name in handlers:
+            handlers[name](val, float(stamp) if stamp else None)
+
+   def onPing(self, value, stamp = None):
       self.__last_ping_time = time.time()
 
-   def onIR(self, cmd):
-      self.__last_ir_value = cmd.value
+   def onIR(self, value, stamp = None):
+      self.__last_ir_value = value
+      self.__last_ir_stamp = self.__sampleTime(stamp)
+      self.__addSample(self.__irHistory, value)
 
-   def onPower(self, cmd):
-      self.__last_power_value = cmd.value
+   def onPower(self, value, stamp = None):
+      self.__last_power_value = value
+      self.__last_power_stamp = self.__sampleTime(stamp)
+      self.__addSample(self.__powerHistory, value)
+
+   def __sampleTime(self, stamp):
+      '''Local monotonic time of a server sample stamp, age is taken against the server time of its frame'''
+      age = 0
+      if stamp is not None and self.__server_time is not None:
+         age = max(0, self.__server_time - stamp)
+      return time.monotonic() - age
+
+   def __stale(self, stamp):
+      return stamp is not None and time.monotonic() - stamp > STALE_SEC
+
+   def __addSample(self, history, value):
+      # Server stamps are its own clock, the history is kept on ours
+      try:
+         history.add(float(value))
+      except ValueError:
+         pass
+
+   def __sparkline(self, key, history, fmt, row):
+      '''Sparkline of history right to the text of row'''
+      sparkline = self.__sparklines.get(key)
+      if sparkline is None:
+         sparkline = self.__sparklines[key] = Sparkline(history, self.__smallFont, fmt, LIGHT_GREEN)
+      surface = sparkline.render()
+      widget = self.__widget(('spark', key))
+      if surface is None:
+         widget.hide()
+      else:
+         widget.show(surface, (SPARK_X, FRAME_POS[1] + 50 * (row - 1)))
 
    def __handlePing(self):
       alive = time.time() - self.__last_ping_time < ALIVE_SEC
       txt = 'Brick connection lost'
       color = RED if int(time.time()) % 2 == 0 else BLACK
       if alive:
-         txt = 'Brick Connected'
+         txt = self.__rttText('Brick', EV3_CMD) or 'Brick Connected'
          color = LIGHT_GREEN
       else:
          self.__cmdTransport.reconnectEv3()
          self.__last_ir_value = '0'
 
-      render = self.__font.render(txt, True, color)
+      render = self.__text.render(self.__font, txt, True, color)
       self.__txtRow(render, row=3)
+      self.__sparkline('rtt', self.__cmdTransport.pings()[EV3_CMD].history, '{:.0f}', row=3)
+
+      txt = self.__rttText('Arduino', ARDUINO_CMD)
+      if txt is None:
+         self.__widget(('row', 9)).hide()
+      else:
+         self.__txtRow(self.__text.render(self.__font, txt, True, LIGHT_GREEN), row=9)
+
+   def __rttText(self, name, dest):
+      rtt = self.__cmdTransport.pings()[dest].rtt
+      if not rtt.count:
+         return None
+      return '{} rtt {:.0f}/{:.0f} ms'.format(name, rtt.percentile(50) * 1000, rtt.percentile(99) * 1000)
 
    def __handleArm(self):
       txt = 'Arm: {}/{}'.format(self.__arm1, self.__arm2)
       color = LIGHT_GREEN
 
-      render = self.__font.render(txt, True, color)
+      render = self.__text.render(self.__font, txt, True, color)
       self.__txtRow(render, row=7)
 
    def __handleCam(self):
       txt = 'Camera view'
       color = LIGHT_GREEN
 
-      render = self.__font.render(txt, True, color)
+      render = self.__text.render(self.__font, txt, True, color)
       self.__txtRow(render, row=4)
 
    def __handleGear(self):
       txt = 'Gear: {}'.format(self.__gear)
       color = LIGHT_GREEN
 
-      render = self.__font.render(txt, True, color)
+      render = self.__text.render(self.__font, txt, True, color)
       self.__txtRow(render, row=8)
 
 
@@ -396,6 +1497,7 @@ class RoboControl:
       try:
          val = float(self.__last_power_value)
       except:
+         self.__widget(('row', 2)).hide()
          return
       ok = val > LOW_POWER
       txt = 'Low battery {:.2f}V'.format(val)
@@ -403,9 +1505,12 @@ class RoboControl:
       if ok:
          txt = 'Battery {:.2f}V'.format(val)
          color = LIGHT_GREEN
+      if self.__stale(self.__last_power_stamp):
+         color = GREY
 
-      render = self.__font.render(txt, True, color)
+      render = self.__text.render(self.__font, txt, True, color)
       self.__txtRow(render, row=2)
+      self.__sparkline('power', self.__powerHistory, '{:.2f}', row=2)
 
    def __joysticStatus(self):
       ok = self.__joystick.isReady()
@@ -415,38 +1520,57 @@ class RoboControl:
          txt = 'Joystick ready'
          color = LIGHT_GREEN
 
-      render = self.__font.render(txt, True, color)
+      render = self.__text.render(self.__font, txt, True, color)
       self.__txtRow(render, row=4)
 
    def __handleDistance(self):
       try:
          val = int(self.__last_ir_value)
       except:
+         self.__widget(('row', 10)).hide()
          return
       color = LIGHT_GREEN if val > MIN_DISTANCE else RED
-      dist = int(val / 10) * '='
-      render = self.__font.render('{} {}>|'.format(val, dist), True, color)
+      if self.__stale(self.__last_ir_stamp):
+         # Not refreshed for several keep-alives, the rover may be elsewhere by now
+         color = GREY
+      render = self.__text.render(self.__font, 'Distance {}'.format(val), True, color)
       self.__txtRow(render, row=10)
+      self.__sparkline('ir', self.__irHistory, '{:.0f}', row=10)
+
+   def __handleReplay(self):
+      if self.__replay is None:
+         return
+      txt = 'Replay {:.0f}/{:.0f}s x{:g}'.format(self.__replay.elapsed(), self.__replay.duration(), self.__replay.speed)
+      render = self.__text.render(self.__font, txt, True, LIGHT_GREEN)
+      self.__txtRow(render, row=11)
 
    def button(self, msg, x, y, w, h, ic, ac, action = None):
       mouse = pygame.mouse.get_pos()
       click = pygame.mouse.get_pressed()
-      if x+w > mouse[0] > x and y+h > mouse[1] > y:
-         pygame.draw.rect(self.__screen, ac,(x,y,w,h))
-
-         if click[0] == 1 and action != None:
-            action()         
-      else:
-         pygame.draw.rect(self.__screen, ic,(x,y,w,h))
-
-      smallText = pygame.font.SysFont("comicsansms", 20)
-      textSurf, textRect = text_objects(msg, smallText)
-      textRect.center = ((x+(w/2)), (y+(h/2)) )
-      self.__screen.blit(textSurf, textRect)
+      active = x+w > mouse[0] > x and y+h > mouse[1] > y
+      if active and click[0] == 1 and action != None:
+         action()
+
+      surface = self.__buttonSurface(msg, w, h, ac if active else ic)
+      self.__widget(('button', msg)).show(surface, (x, y))
+
+   def __buttonSurface(self, msg, w, h, color):
+      key = (msg, w, h, tuple(color))
+      surface = self.__buttons.get(key)
+      if surface is None:
+         surface = self.__buttons[key] = pygame.Surface((w, h))
+         surface.fill(color)
+         textSurf = self.__text.render(self.__buttonFont, msg, True, BLACK)
+         textRect = textSurf.get_rect()
+         textRect.center = (w/2, h/2)
+         surface.blit(textSurf, textRect)
+      return surface
 
    def camView(self):
-      frame = pygame.transform.rotate(self.__camViewFrame, self.__cam)
-      self.__screen.blit(frame, (900, 300))
+      if self.__cam != self.__camViewAngle:
+         self.__camViewAngle = self.__cam
+         self.__camViewRotated = pygame.transform.rotate(self.__camViewFrame, self.__cam)
+      self.__widget('camview').show(self.__camViewRotated, (900, 300))
 
    def closeArm(self):
       self.__arm2 = 0
@@ -499,7 +1623,8 @@ class RoboControl:
       ]
 
       for c in cmd:
-         self.__cmdTransport.send(c)
+         # Demo steps must not be merged
+         self.__cmdTransport.send(c, coalesce=False)
          pygame.display.flip()
          time.sleep(2)
 
@@ -515,14 +1640,52 @@ class RoboControl:
       cmd = Cmd('shutdown', 1, EV3_CMD)
       self.__cmdTransport.send(cmd)
 
+   def __dumpLog(self):
+      '''Client ring goes to LOG_DUMP, brick writes its own dump file'''
+      count = log.dump(LOG_DUMP)
+      log.info('dumped %s log entries to %s', count, LOG_DUMP)
+      self.__cmdTransport.send(Cmd('dumplog', '', EV3_CMD), coalesce=False)
+
+   def textStats(self):
+      return self.__text.stats()
+
+   def renderStats(self):
+      return {'wakeups': self.wakeups, 'updates': self.updates}
+
+   def telemetryStats(self):
+      '''Last tm frame sequence number and frames missing before it'''
+      return {'seq': self.__telemetry_seq, 'lost': self.__telemetry_lost}
+
+   def __stop(self):
+      self.__webFrame.stop()
+      self.__cmdTransport.stop()
+      if PING_EXPORT:
+         self.__cmdTransport.exportPings(PING_EXPORT)
+      if self.__recorder is not None:
+         self.__recorder.close()
+         log.info('recorded: %s', self.__recorder.stats())
+      if self.__replay is not None:
+         log.info('replayed: %s', self.__replay.stats())
+      log.info('text cache: %s', self.__text.stats())
+      log.info('render: %s', self.renderStats())
+      log.info('telemetry: %s', self.telemetryStats())
+      log.close()
+      sys.exit()
+
    def __loop(self):
+      self.__redraw()
+      pygame.display.flip()
+      # Nothing changes between input and camera frames but telemetry and blinking warnings
+      pygame.time.set_timer(IDLE_EVENT, int(1000 / IDLE_FPS))
 
       ctrl = False
       while True:
-         self.__screen.blit(self.__bkgnd_img, (0, 0))
+         # Sleeps until user input, a new camera frame or the idle tick
+         events = [pygame.event.wait()] + pygame.event.get()
+         self.wakeups += 1
 
          frame = self.__webFrame.getFrame()
-         self.__screen.blit(frame, FRAME_POS)
+         self.__widget('frame').show(frame, FRAME_POS)
 
          self.camView()
 
@@ -533,6 +1696,7 @@ class RoboControl:
          self.__handlePing()
          self.__handlePower()
          self.__handleGear()
+         self.__handleReplay()
          #self.__joysticStatus()
 
 
@@ -556,11 +1720,14 @@ class RoboControl:
             self.__cam = 85
 
          cmd = None
-         for event in pygame.event.get():
+         exposed = False
+         for event in events:
             if event.type == pygame.QUIT:
-               self.__webFrame.stop()
-               self.__cmdTransport.stop()
-               sys.exit()
+               self.__stop()
+
+            elif event.type == pygame.VIDEOEXPOSE:
+               self.__redraw()
+               exposed = True
 
             elif event.type == pygame.KEYUP:
                if event.key in [pygame.K_LEFT, pygame.K_RIGHT] and \
@@ -591,9 +1758,14 @@ class RoboControl:
                   cmd = Cmd('gear', '1', EV3_CMD)
             elif event.type in [pygame.KEYDOWN]:
                if event.key == pygame.K_ESCAPE:
-                  self.__webFrame.stop()
-                  self.__cmdTransport.stop()
-                  sys.exit()
+                  self.__stop()
+               elif event.key == pygame.K_F12:
+                  self.__dumpLog()
+               elif event.key in [pygame.K_PAGEUP, pygame.K_PAGEDOWN, pygame.K_HOME] and self.__replay is not None:
+                  if event.key == pygame.K_HOME:
+                     self.__replay.seek(0)
+                  else:
+                     self.__replay.skip(Replay.SeekSec if event.key == pygame.K_PAGEUP else -Replay.SeekSec)
                elif event.key == pygame.K_SPACE:
                   self.__laser = 1
                   cmd = Cmd('laser', self.__laser, ARDUINO_CMD)
@@ -635,11 +1807,26 @@ class RoboControl:
          #for cmd in data:
          #   self.__cmdTransport.send(cmd)
 
-         pygame.display.flip()
-         self.__clock.tick(60)
+         rects = self.__draw()
+         if exposed:
+            self.updates += 1
+            pygame.display.flip()
+         elif rects:
+            self.updates += 1
+            pygame.display.update(rects)
+         self.__clock.tick(MAX_FPS)
 
 if __name__ == '__main__':
    import sys
+   import argparse
+   parser = argparse.ArgumentParser(description='Curiosity rover control')
+   parser.add_argument('--replay', help='play recorded session (.seg/.idx) instead of connecting to the robot')
+   parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 2 is twice as fast')
+   parser.add_argument('--start', type=float, default=0, help='replay from this second of the session')
+   parser.add_argument('--loop', action='store_true', help='replay again from the start when the session ends')
+   args = parser.parse_args()
+
+   log.dumpOnCrash(LOG_DUMP)
    c = RoboControl()
 
    class JoystickTest:
@@ -652,4 +1839,7 @@ if __name__ == '__main__':
       def read(self):
          return [Cmd('test', 'test')]
 
-   c.run(JoystickTest)
+   replay = None
+   if args.replay:
+      replay = Replay(args.replay, args.speed, args.start, args.loop)
+   c.run(JoystickTest, replay)
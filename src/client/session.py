@@ -0,0 +1,177 @@
+#!/usr/bin/python3.4
+# @file session.py
+#
+# Drive session recording: camera jpegs as they came from the camera, commands sent
+# and messages received, each with a monotonic timestamp.
+# <name>.seg: SEGMENT_MAGIC, then records of RECORD header and payload.
+# <name>.idx: INDEX_MAGIC, then one fixed width INDEX entry per record, so a reader can
+# find a record by number or binary search it by time without scanning the segment.
+
+import json
+import mmap
+import time
+import struct
+import threading
+import collections
+
+SEGMENT_MAGIC = b'EV3SEG1\n'
+INDEX_MAGIC = b'EV3IDX1\n'
+RECORD = struct.Struct('<BdI')     # kind, monotonic stamp, payload length
+INDEX = struct.Struct('<dQIB3x')   # monotonic stamp, payload offset in segment, payload length, kind
+
+# Record kinds
+META = 0       # json: session start, frame size, client version
+FRAME = 1      # raw jpeg bytes
+SENT = 2       # 'dest cmd:value;'
+RECEIVED = 3   # 'dest cmd:value;...' as read from the socket
+
+KIND_NAMES = {META: 'meta', FRAME: 'frame', SENT: 'sent', RECEIVED: 'received'}
+
+class Recorder:
+   '''Appends records from a background thread. Callers only queue them: the queue is bounded in bytes,
+      when the disk does not keep up new records are dropped and counted, memory use stays the same'''
+   MaxPending = 32 * 1024 * 1024
+
+   def __init__(self, path, meta = None, maxPending = None):
+      self.path = path
+      self.maxPending = maxPending or self.MaxPending
+      self.__segment = open(path + '.seg', 'wb')
+      self.__index = open(path + '.idx', 'wb')
+      self.__segment.write(SEGMENT_MAGIC)
+      self.__index.write(INDEX_MAGIC)
+      self.__offset = len(SEGMENT_MAGIC)
+
+      self.__cond = threading.Condition()
+      self.__pending = collections.deque()
+      self.__pendingBytes = 0
+
+      self.records = 0
+      self.bytes = 0
+      self.dropped = 0
+      self.frames = 0
+
+      self.started = True
+      self.__thread = threading.Thread(target=self.__writeLoop)
+      self.__thread.daemon = True
+      self.__thread.start()
+
+      info = {'wall': time.time(), 'monotonic': time.monotonic()}
+      info.update(meta or {})
+      self.__put(META, json.dumps(info).encode())
+
+   def frame(self, jpeg):
+      self.__put(FRAME, jpeg)
+
+   def sent(self, dest, cmd):
+      self.__put(SENT, '{} {}'.format(dest, cmd).encode())
+
+   def received(self, dest, data):
+      self.__put(RECEIVED, '{} {}'.format(dest, data).encode())
+
+   def __put(self, kind, payload):
+      with self.__cond:
+         if not self.started or self.__pendingBytes + len(payload) > self.maxPending:
+            self.dropped += 1
+            return
+         # Stamped under the lock, so the index is sorted by time
+         self.__pending.append((kind, time.monotonic(), payload))
+         self.__pendingBytes += len(payload)
+         self.__cond.notify()
+
+   def __writeLoop(self):
+      while True:
+         with self.__cond:
+            while self.started and not self.__pending:
+               self.__cond.wait()
+            records = list(self.__pending)
+            self.__pending.clear()
+            self.__pendingBytes = 0
+            if not records and not self.started:
+               break
+         self.__write(records)
+
+   def __write(self, records):
+      for kind, stamp, payload in records:
+         header = RECORD.pack(kind, stamp, len(payload))
+         self.__segment.write(header)
+         self.__segment.write(payload)
+         self.__index.write(INDEX.pack(stamp, self.__offset + len(header), len(payload), kind))
+         self.__offset += len(header) + len(payload)
+         self.records += 1
+         self.bytes += len(payload)
+         if kind == FRAME:
+            self.frames += 1
+      # Index never points past written data
+      self.__segment.flush()
+      self.__index.flush()
+
+   def stats(self):
+      return {'records': self.records, 'frames': self.frames, 'bytes': self.bytes,
+              'dropped': self.dropped, 'pending': self.__pendingBytes}
+
+   def close(self):
+      with self.__cond:
+         self.started = False
+         self.__cond.notify()
+      self.__thread.join()
+      self.__segment.close()
+      self.__index.close()
+
+class Session:
+   '''Recorded session, both files are memory mapped: opening does not read them,
+      a record is paged in only when its payload is asked for'''
+   def __init__(self, path):
+      if path.endswith(('.seg', '.idx')):
+         path = path[:-len('.seg')]
+      self.path = path
+      self.__files = [open(path + '.seg', 'rb'), open(path + '.idx', 'rb')]
+      self.__segment, self.__index = [mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) for f in self.__files]
+      if self.__segment[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC or self.__index[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+         self.close()
+         raise ValueError('{} is not a session recording'.format(path))
+      # Index of a session cut by a crash may end with a partial entry
+      self.count = (len(self.__index) - len(INDEX_MAGIC)) // INDEX.size
+
+   def __len__(self):
+      return self.count
+
+   def entry(self, i):
+      '''(stamp, offset, length, kind) of record i'''
+      return INDEX.unpack_from(self.__index, len(INDEX_MAGIC) + i * INDEX.size)
+
+   def stamp(self, i):
+      return self.entry(i)[0]
+
+   def payload(self, i):
+      stamp, offset, length, kind = self.entry(i)
+      return self.__segment[offset:offset + length]
+
+   def start(self):
+      return self.stamp(0) if self.count else 0.0
+
+   def end(self):
+      return self.stamp(self.count - 1) if self.count else 0.0
+
+   def seek(self, stamp):
+      '''Number of the first record at or after stamp, binary search over the index'''
+      lo, hi = 0, self.count
+      while lo < hi:
+         mid = (lo + hi) // 2
+         if self.stamp(mid) < stamp:
+            lo = mid + 1
+         else:
+            hi = mid
+      return lo
+
+   def meta(self):
+      for i in range(min(self.count, 16)):
+         if self.entry(i)[3] == META:
+            return json.loads(self.payload(i).decode())
+      return {}
+
+   def close(self):
+      for m in [self.__segment, self.__index]:
+         m.close()
+      for f in self.__files:
+         f.close()
+
@@ -0,0 +1,194 @@
+#!/usr/bin/python3.4
+# @file ev3log.py
+#
+# Logger shared by ev3server and ev3client.
+# Callers only append (time, level, msg, args) to deques, formatting and writing
+# are done by a background thread in batches. Disabled levels are bound to a no-op.
+# The last entries are kept in a ring buffer and can be dumped on crash or on request.
+# Flusher thread starts with the first entry of a process, so it survives daemon forks.
+
+import os
+import sys
+import time
+import threading
+import traceback
+import collections
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+NAMES = dict((level, name.upper()) for name, level in LEVELS.items())
+
+def parseLevel(name):
+   '''Config value -> level, numbers are accepted as well'''
+   name = str(name).strip().lower()
+   return LEVELS[name] if name in LEVELS else int(name)
+
+def noop(*args):
+   pass
+
+def formatEntry(entry):
+   stamp, level, msg, args = entry
+   if args:
+      try:
+         msg = msg % args
+      except (TypeError, ValueError):
+         msg = '{} {}'.format(msg, args)
+   return '{}.{:03d} {:<7} {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp)),
+                                        int(stamp * 1000) % 1000, NAMES.get(level, level), msg)
+
+class Logger:
+   '''log.info('peer %s', addr): arguments are formatted by the flusher thread, not by the caller'''
+   FlushSec = 0.5
+   BatchSize = 256   # pending entries that wake the flusher before FlushSec
+   MaxPending = 10000   # entries not written yet, the oldest are dropped beyond that
+
+   def __init__(self, level = INFO, path = None, stream = sys.stdout, ring = 1000):
+      self.stream = stream
+      self.__path = None
+      self.__file = None   # opened by the first write
+      self.__ring = collections.deque(maxlen=ring)   # last entries of every level
+      self.__pending = collections.deque(maxlen=self.MaxPending)   # entries not written yet
+      self.__wake = threading.Event()
+      self.__lock = threading.Lock()                 # serializes writers, not callers
+      self.__startLock = threading.Lock()
+      self.written = 0
+      self.batches = 0
+      self.dropped = 0
+      self.setLevel(level)
+      if path:
+         self.open(path)
+
+      self.started = True
+      self.__pid = None   # process the flusher thread runs in
+
+   def setLevel(self, level):
+      self.level = level
+      self.debug = self.__logger(DEBUG)
+      self.info = self.__logger(INFO)
+      self.warning = self.__logger(WARNING)
+      self.error = self.__logger(ERROR)
+
+   def __logger(self, level):
+      if level < self.level:
+         return noop
+      def log(msg, *args):
+         if self.__pid != os.getpid():
+            self.__startFlusher()
+         entry = (time.time(), level, msg, args)
+         self.__ring.append(entry)
+         if len(self.__pending) == self.MaxPending:
+            self.dropped += 1
+         self.__pending.append(entry)
+         if level >= ERROR or len(self.__pending) >= self.BatchSize:
+            self.__wake.set()
+      return log
+
+   def exception(self, msg, *args):
+      '''Error with the traceback of the exception being handled'''
+      self.error('%s\n%s', msg % args if args else msg, traceback.format_exc().rstrip())
+
+   def open(self, path):
+      '''Appends to path from now on, None stops writing to a file'''
+      with self.__lock:
+         if self.__file is not None:
+            self.__file.close()
+         self.__file = None
+         self.__path = path
+
+   def resize(self, ring):
+      self.__ring = collections.deque(self.__ring, maxlen=ring)
+
+   def __startFlusher(self):
+      '''Threads do not survive fork, a forked child starts its own flusher'''
+      with self.__startLock:
+         if self.__pid == os.getpid():
+            return
+         if self.__pid is not None:
+            # Parent's flusher might have held the lock at fork
+            self.__lock = threading.Lock()
+         self.__pid = os.getpid()
+         thread = threading.Thread(target=self.__flushLoop)
+         thread.daemon = True
+         thread.start()
+
+   def __flushLoop(self):
+      while self.started:
+         self.__wake.wait(self.FlushSec)
+         self.__wake.clear()
+         self.flush()
+
+   def flush(self):
+      with self.__lock:
+         entries = []
+         while self.__pending:
+            entries.append(self.__pending.popleft())
+         if not entries:
+            return
+         text = ''.join(formatEntry(entry) for entry in entries)
+         if self.__path and self.__file is None:
+            try:
+               self.__file = open(self.__path, 'a')
+            except OSError:
+               self.__path = None
+         for out in [self.stream, self.__file]:
+            if out is None:
+               continue
+            try:
+               out.write(text)
+               out.flush()
+            except (OSError, ValueError):
+               # Closed or detached stdout of a daemon
+               pass
+         self.written += len(entries)
+         self.batches += 1
+
+   def entries(self, count = None):
+      '''Last count entries of the ring formatted, all of them if count is None'''
+      entries = list(self.__ring)
+      if count is not None:
+         entries = entries[-count:] if count > 0 else []
+      return [formatEntry(entry) for entry in entries]
+
+   def dump(self, path, count = None):
+      '''Writes last entries to path right away, returns their number'''
+      lines = self.entries(count)
+      with open(path, 'w') as f:
+         f.writelines(lines)
+      return len(lines)
+
+   def dumpOnCrash(self, path, count = None):
+      '''Uncaught exceptions of any thread are logged and the ring is dumped to path'''
+      def crash(kind, value, tb):
+         self.error('uncaught %s', ''.join(traceback.format_exception(kind, value, tb)).rstrip())
+         self.flush()
+         try:
+            self.dump(path, count)
+         except OSError:
+            pass
+
+      excepthook = sys.excepthook
+      def hook(kind, value, tb):
+         crash(kind, value, tb)
+         excepthook(kind, value, tb)
+      sys.excepthook = hook
+
+      if hasattr(threading, 'excepthook'):
+         threadhook = threading.excepthook
+         def threadHook(args):
+            crash(args.exc_type, args.exc_value, args.exc_traceback)
+            threadhook(args)
+         threading.excepthook = threadHook
+
+   def stats(self):
+      return {'written': self.written, 'batches': self.batches, 'dropped': self.dropped,
+              'pending': len(self.__pending), 'ring': len(self.__ring)}
+
+   def close(self):
+      self.started = False
+      self.__wake.set()
+      self.flush()
+      self.open(None)
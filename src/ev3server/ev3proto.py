@@ -0,0 +1,69 @@
+#!/usr/bin/python3.4
+# @file ev3proto.py
+#
+# Compact binary command framing, used next to the text 'cmd:value;' protocol.
+# Frame: magic byte, payload length, opcode, fixed width payload.
+# Magic byte never starts a text frame, so both kinds may be mixed in one stream.
+# Client asks for it with 'proto:bin1;', server answers 'proto:bin1;' if it understands it.
+
+import struct
+
+VERSION = 'bin1'
+MAGIC = 0xB1
+HEADER = struct.Struct('<BBB')   # magic, payload length, opcode
+
+# Payload is 'cmd:value' utf-8 text, for commands without binary layout
+TEXT = 0
+
+# opcode: (cmd, payload fields), f - float32, h - int16
+FIELDS = {1: ('drive', 'ff'),
+          2: ('xy', 'ff'),
+          3: ('gear', 'h'),
+          4: ('arm', 'f')}
+
+OPCODES = dict((opcode, (cmd, fields, struct.Struct('<' + fields))) for opcode, (cmd, fields) in FIELDS.items())
+COMMANDS = dict((cmd, (opcode, fields, layout)) for opcode, (cmd, fields, layout) in OPCODES.items())
+
+def encode(cmd, value):
+   '''Command frame, value is either a number or a text like "0.3,0.3"'''
+   if cmd not in COMMANDS:
+      return encodeText(cmd, value)
+   opcode, fields, layout = COMMANDS[cmd]
+   values = [float(v) for v in str(value).split(',')]
+   payload = layout.pack(*[int(v) if f == 'h' else v for f, v in zip(fields, values)])
+   return HEADER.pack(MAGIC, len(payload), opcode) + payload
+
+def encodeText(cmd, value):
+   '''TEXT opcode frame, any value fits'''
+   payload = '{}:{}'.format(cmd, value).encode()
+   if len(payload) > 255:
+      # Does not fit length byte, plain text frame may be mixed in
+      return payload + b';'
+   return HEADER.pack(MAGIC, len(payload), TEXT) + payload
+
+def decode(opcode, payload):
+   '''Text command as str, binary one as (cmd, args), single field args is a scalar'''
+   if opcode == TEXT:
+      return payload.decode('utf-8', 'replace')
+   cmd, fields, layout = OPCODES[opcode]
+   args = layout.unpack(payload)
+   return cmd, args[0] if len(args) == 1 else list(args)
+
+# UDP motion setpoint datagram: magic, opcode, session token, sequence number, client time, two float32 fields.
+# Receiver applies only the newest sequence number per token.
+MOTION = struct.Struct('<BBIIdff')
+MOTION_CMDS = ['drive', 'xy']
+
+def encodeMotion(token, seq, stamp, cmd, value):
+   opcode = COMMANDS[cmd][0]
+   a, b = [float(v) for v in str(value).split(',')]
+   return MOTION.pack(MAGIC, opcode, token, seq, stamp, a, b)
+
+def decodeMotion(data):
+   '''(token, seq, stamp, cmd, [a, b]), raises ValueError for anything else'''
+   if len(data) != MOTION.size:
+      raise ValueError('bad motion datagram size {}'.format(len(data)))
+   magic, opcode, token, seq, stamp, a, b = MOTION.unpack(data)
+   if magic != MAGIC or opcode not in OPCODES or OPCODES[opcode][0] not in MOTION_CMDS:
+      raise ValueError('bad motion datagram')
+   return token, seq, stamp, OPCODES[opcode][0], [a, b]
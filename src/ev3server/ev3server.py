@@ -2,258 +2,1037 @@
 # @file ev3server.py
 # @author Pavel Cherezov (cherezov.pavel@gmail.com)
 
+import re
 import time
+import heapq
+import itertools
 import socket
-import select
+import selectors
 import threading
 import queue
+import collections
 from subprocess import call
 
+import ev3proto
+import ev3log
+
+# Configured by run(), quite server logs warnings only
+log = ev3log.Logger()
+
 __version__ = '0.8'
 
-class ev3devEmulator:
+try:
+   import ev3dev.ev3 as ev3
+except:
+   log.warning('Error: ev3dev module not found, using simulated devices')
+   import ev3sim as ev3
+
+def floats(value):
+   '''"0.3,-0.3" -> [0.3, -0.3]'''
+   return [float(v) for v in value.split(',')]
+
+class CmdHandler:
+   '''Registered command: handler, argument parser and execution stats.
+      Motion handlers are accepted from the controlling peer only'''
+   def __init__(self, name, func, parse, motion):
+      self.name = name
+      self.func = func
+      self.parse = parse
+      self.motion = motion
+      self.count = 0
+      self.total = 0.0
+      self.max = 0.0
+
+   def __call__(self, value, parsed = False):
+      start = time.perf_counter()
+      try:
+         self.func(value if parsed else self.parse(value))
+      finally:
+         elapsed = time.perf_counter() - start
+         self.count += 1
+         self.total += elapsed
+         self.max = max(self.max, elapsed)
+
+   def stats(self):
+      return {'count': self.count,
+              'total': self.total,
+              'avg': self.total / self.count if self.count else 0.0,
+              'max': self.max}
+
+class CmdRegistry:
+   '''Command name -> CmdHandler map, server and plugins add their commands with register()'''
    def __init__(self):
-      print('ev3 emulator started.')
+      self.__handlers = {}
 
-   class LargeMotor:
-      def __init__(self, name):
-         print('Large motor "{}" created.'.format(name) )
+   def register(self, name, func, parse = str, motion = False):
+      '''parse converts raw value string to the handler argument, e.g. int, float or floats'''
+      self.__handlers[name] = CmdHandler(name, func, parse, motion)
 
-   class Sound:
-      def __init__(self):
-         pass
+   def unregister(self, name):
+      self.__handlers.pop(name, None)
 
-      def speak(self, text):
-         return self
+   def get(self, name):
+      return self.__handlers.get(name)
 
-      def wait(self):
-         pass
+   def dispatch(self, cmd, value, parsed = False):
+      '''Returns False for unknown command. Binary protocol commands come already parsed'''
+      handler = self.__handlers.get(cmd)
+      if handler is None:
+         return False
+      handler(value, parsed)
+      return True
 
-try:
-   import ev3dev.ev3 as ev3
-except:
-   print('Error: ev3dev module not found!')
-   ev3 = ev3devEmulator()
+   def stats(self):
+      return dict((name, handler.stats()) for name, handler in self.__handlers.items())
+
+class ActionWorker:
+   '''Runs slow actions (speech, update, restart, shutdown) off the network loop, one at a time.
+      Pending actions are bounded; a coalesced action replaces its pending value in place.
+      Results are reported with done(name, owner) and error(name, owner, reason) callbacks, called from the worker or the submitting thread.
+      Every submitted action gets one of them, a replaced or cancelled one gets error with superseded or cancelled'''
+   MaxPending = 8
+
+   def __init__(self, done, error):
+      self.__done = done
+      self.__error = error
+      self.__cond = threading.Condition()
+      self.__pending = collections.deque()   # [name, func, value, owner]
+      self.current = None
+      self.coalesced = 0
+      self.rejected = 0
+
+      self.__thread = threading.Thread(target=self.__loop)
+      self.__thread.daemon = True
+      self.__thread.start()
+
+   def submit(self, name, func, value, owner = None, coalesce = False):
+      '''Returns False if too many actions are pending'''
+      with self.__cond:
+         if coalesce:
+            for action in self.__pending:
+               if action[0] == name:
+                  self.__error(name, action[3], 'superseded')
+                  action[2] = value
+                  action[3] = owner
+                  self.coalesced += 1
+                  return True
+
+         if len(self.__pending) >= self.MaxPending:
+            self.rejected += 1
+            return False
+
+         self.__pending.append([name, func, value, owner])
+         self.__cond.notify()
+         return True
+
+   def cancel(self, name):
+      '''Drops pending actions with given name, returns their number'''
+      with self.__cond:
+         pending = [action for action in self.__pending if action[0] != name]
+         dropped = len(self.__pending) - len(pending)
+         for action in self.__pending:
+            if action[0] == name:
+               self.__error(name, action[3], 'cancelled')
+         self.__pending = collections.deque(pending)
+         return dropped
+
+   def __loop(self):
+      while True:
+         with self.__cond:
+            while not self.__pending:
+               self.__cond.wait()
+            name, func, value, owner = self.__pending.popleft()
+            self.current = name
+
+         try:
+            func(value)
+            self.__done(name, owner)
+         except Exception as e:
+            self.__error(name, owner, e)
+         finally:
+            self.current = None
+
+class CmdParser:
+   '''Incremental framing: keeps incomplete tail between reads, emits only complete frames.
+      Text "cmd:value;" frames are emitted as str, binary ev3proto frames as (cmd, args).
+      New line terminates a text frame too, so "echo cmd:value | nc" still works'''
+   Terminator = re.compile(b'[;\n]')
+   MaxFrame = 1024
+
+   def __init__(self):
+      self.__buffer = b''
+      self.overflows = 0
+      self.errors = 0
+
+   def feed(self, data):
+      data = self.__buffer + data
+      frames = []
+      pos = 0
+      while pos < len(data):
+         if data[pos] == ev3proto.MAGIC:
+            if len(data) - pos < ev3proto.HEADER.size:
+               break
+            magic, length, opcode = ev3proto.HEADER.unpack_from(data, pos)
+            end = pos + ev3proto.HEADER.size + length
+            if len(data) < end:
+               break
+            try:
+               frames.append(ev3proto.decode(opcode, data[pos + ev3proto.HEADER.size:end]))
+            except Exception:
+               self.errors += 1
+            pos = end
+         else:
+            terminator = self.Terminator.search(data, pos)
+            if terminator is None:
+               break
+            # Terminators are ascii, so utf-8 characters are never cut within complete frame
+            frame = data[pos:terminator.start()].strip()
+            if frame:
+               frames.append(frame.decode('utf-8', 'replace'))
+            pos = terminator.end()
+
+      self.__buffer = data[pos:]
+      if len(self.__buffer) > self.MaxFrame:
+         # No terminator for too long, garbage
+         self.__buffer = b''
+         self.overflows += 1
+      return frames
+
+class MotorState:
+   '''Motor wrapper: static attributes are read once, writes that would not change the motor are skipped.
+      Every sysfs write is counted in writes, every skipped one in elided'''
+   def __init__(self, motor):
+      self.motor = motor
+      self.max_speed = motor.max_speed
+      self.__speed = None
+      self.__command = None   # last command sent: 'forever', 'timed' or 'stop'
+      self.writes = 0
+      self.elided = 0
+
+   def runForever(self, speed):
+      speed = int(round(speed))
+      if self.__command == 'forever' and speed == self.__speed:
+         # speed_sp and run-forever command
+         self.elided += 2
+         return
+
+      if speed != self.__speed:
+         self.motor.speed_sp = speed
+         self.__speed = speed
+         self.writes += 1
+      else:
+         self.elided += 1
+      self.motor.run_forever()
+      self.__command = 'forever'
+      self.writes += 1
+
+   def runTimed(self, time_sp, speed_sp):
+      # Timed run ends by itself, state is unknown afterwards
+      self.motor.run_timed(time_sp=time_sp, speed_sp=speed_sp)
+      self.__speed = speed_sp
+      self.__command = 'timed'
+      self.writes += 3
+
+   def stop(self):
+      if self.__command == 'stop':
+         self.elided += 1
+         return
+      self.motor.stop()
+      self.__command = 'stop'
+      self.writes += 1
+
+   def stats(self):
+      return {'writes': self.writes, 'elided': self.elided}
+
+class Sensor:
+   '''Periodically sampled value, pushed when changed beyond deadband or when keep-alive passed'''
+   def __init__(self, name, read, interval, deadband, keepalive):
+      self.name = name
+      self.read = read
+      self.interval = interval
+      self.deadband = deadband
+      self.keepalive = keepalive
+
+      self.value = None
+      self.stamp = 0
+      self.nextSample = 0
+      self.sentValue = None
+      self.sentTime = 0
+
+      self.reads = 0
+      self.errors = 0
+      self.pushed = 0
+
+   def changed(self):
+      if self.sentValue is None:
+         return True
+      try:
+         return abs(self.value - self.sentValue) > self.deadband
+      except TypeError:
+         return self.value != self.sentValue
+
+class Sampler:
+   '''Reads sensors on own thread into a shared snapshot, so command handling never waits for sysfs.
+      notify() is called when any value changed beyond its deadband'''
+   def __init__(self, sensors, notify):
+      self.__sensors = sensors
+      self.__notify = notify
+      self.__lock = threading.Lock()
+      self.__started = True
+      self.__thread = threading.Thread(target=self.__loop)
+      self.__thread.daemon = True
+      self.__thread.start()
+
+   def __loop(self):
+      while self.__started:
+         changed = False
+         for sensor in self.__sensors:
+            now = time.monotonic()
+            if sensor.nextSample > now:
+               continue
+            sensor.nextSample = now + sensor.interval
+            try:
+               value = sensor.read()
+            except Exception:
+               sensor.errors += 1
+               continue
+            with self.__lock:
+               sensor.value = value
+               sensor.stamp = time.monotonic()
+               sensor.reads += 1
+               changed = changed or sensor.changed()
+
+         if changed:
+            self.__notify()
+         time.sleep(max(0, min(sensor.nextSample for sensor in self.__sensors) - time.monotonic()))
+
+   def due(self):
+      '''Values to push now as (name, value, stamp), they are considered sent'''
+      values = []
+      now = time.monotonic()
+      with self.__lock:
+         for sensor in self.__sensors:
+            if sensor.value is None:
+               continue
+            if sensor.changed() or now - sensor.sentTime >= sensor.keepalive:
+               sensor.sentValue = sensor.value
+               sensor.sentTime = now
+               sensor.pushed += 1
+               values.append((sensor.name, sensor.value, sensor.stamp))
+      return values
+
+   def nextDue(self):
+      '''Seconds until the nearest keep-alive push, None if nothing was sampled yet'''
+      with self.__lock:
+         deadlines = [sensor.sentTime + sensor.keepalive for sensor in self.__sensors if sensor.value is not None]
+      if not deadlines:
+         return None
+      return max(0, min(deadlines) - time.monotonic())
+
+   def snapshot(self):
+      with self.__lock:
+         return dict((sensor.name, (sensor.value, sensor.stamp)) for sensor in self.__sensors)
+
+   def stats(self):
+      return dict((sensor.name, {'reads': sensor.reads, 'errors': sensor.errors, 'pushed': sensor.pushed})
+                  for sensor in self.__sensors)
+
+   def stop(self):
+      self.__started = False
+
+class Timers:
+   '''Deadline heap for the network loop, callbacks run on the loop thread'''
+   def __init__(self):
+      self.__heap = []
+      self.__order = itertools.count()
+      self.fired = 0
+
+   def schedule(self, delay, callback):
+      '''Returns timer handle for cancel()'''
+      timer = [time.monotonic() + delay, next(self.__order), callback]
+      heapq.heappush(self.__heap, timer)
+      return timer
+
+   def cancel(self, timer):
+      if timer is not None:
+         # Cancelled timer stays in the heap until its deadline
+         timer[2] = None
+
+   def timeout(self):
+      '''Seconds until the nearest deadline, None if nothing is scheduled'''
+      while self.__heap and self.__heap[0][2] is None:
+         heapq.heappop(self.__heap)
+      if not self.__heap:
+         return None
+      return max(0, self.__heap[0][0] - time.monotonic())
+
+   def run(self):
+      now = time.monotonic()
+      while self.__heap and self.__heap[0][0] <= now:
+         deadline, order, callback = heapq.heappop(self.__heap)
+         if callback is not None:
+            self.fired += 1
+            callback()
+
+   def __len__(self):
+      return sum(1 for timer in self.__heap if timer[2] is not None)
+
+class Peer:
+   '''Connected client: non-blocking socket, command parser and pending output'''
+   MaxOutput = 64 * 1024
+
+   def __init__(self, sock, addr, legacy):
+      self.sock = sock
+      self.addr = addr
+      self.parser = CmdParser()
+      self.output = bytearray()
+      self.telemetry = True
+      self.legacy = legacy   # per key telemetry messages instead of single frame
+      self.events = selectors.EVENT_READ
+      self.overflows = 0
+      self.lastInput = time.monotonic()
+
+   def fileno(self):
+      return self.sock.fileno()
+
+   def send(self, data):
+      if len(self.output) + len(data) > self.MaxOutput:
+         # Peer does not read, do not let it eat memory
+         self.overflows += 1
+         return
+      self.output.extend(data)
+
+   def flush(self):
+      if self.output:
+         sent = self.sock.send(self.output)
+         del self.output[:sent]
 
 class EV3Server:
-   def __init__(self, port, quite):
+   '''Serves many peers from a single selector loop.
+      Telemetry is read once per tick and sent to every subscribed peer,
+      motion commands are accepted from the peer holding the controller lease only'''
+   RecvSize = 4096
+   Backlog = 32
+
+   # [sampler] section of ev3server.cfg overrides these
+   SamplerDefaults = {'ping-interval': '1.5',
+                      'keepalive': '5',
+                      'ir-interval': '0.2',
+                      'ir-deadband': '1',
+                      'power-interval': '2',
+                      'power-deadband': '0.05'}
+
+   def __init__(self, port, quite, samplerCfg = None, legacyTelemetry = False, udpPort = None, watchdog = 30, logDump = 'ev3server.dump'):
       self.host = socket.gethostbyname(socket.getfqdn())
       self.port = port
       self.quite = quite
+      self.logDump = logDump
+      if quite:
+         log.setLevel(max(log.level, ev3log.WARNING))
       self.__socket = None
       self.__started = False
-      self.__peer_sock = None
-      self.__peer_addr = None
+      self.__selector = None
+      self.__peers = {}
+      self.__peer = None         # peer whose command is being handled
+      self.__controller = None   # peer holding the controller lease
+
+      # Network loop sleeps until the nearest timer or socket input
+      self.__timers = Timers()
+      self.__telemetryTimer = None
+      self.__watchdogTimer = None
+      self.watchdog = watchdog   # motors stop if controller is silent that long, 0 disables
+      self.loopStats = {'wakeups': 0}
 
-      self.__leftMotor = ev3.LargeMotor('outD')
-      self.__rightMotor = ev3.LargeMotor('outA')
-      self.__smallMotor = ev3.MediumMotor('outC')
+      # Optional UDP channel for motion setpoints, peers register their datagram token with 'udp:<token>'
+      self.udpPort = udpPort
+      self.__udp = None
+      self.__motionPeers = {}    # token -> peer
+      self.__motionSeq = {}      # token -> last applied sequence number
+      self.motionStats = {'received': 0, 'applied': 0, 'stale': 0, 'rejected': 0, 'probes': 0}
+
+      self.__leftMotor = MotorState(ev3.LargeMotor('outD'))
+      self.__rightMotor = MotorState(ev3.LargeMotor('outA'))
+      self.__smallMotor = MotorState(ev3.MediumMotor('outC'))
       self.__ir = ev3.InfraredSensor()
       self.__power = ev3.PowerSupply()
 
-      self.__last_ping = 0
-      self.__last_ir = 0
-      self.__last_pwr = 0
+      cfg = dict(self.SamplerDefaults)
+      cfg.update(samplerCfg or {})
+      keepalive = float(cfg['keepalive'])
+      self.__pingInterval = float(cfg['ping-interval'])
+      self.__last_ping = time.monotonic() - self.__pingInterval   # first reply pings at once
+      self.__legacyTelemetry = legacyTelemetry
+      self.__telemetrySeq = 0
 
       self.__gear = 1
 
+      # Replies of background actions, sent by network loop. Worker writes a byte to wake the loop up
+      self.__outbox = queue.Queue()
+      self.__wakeRecv, self.__wakeSend = socket.socketpair()
+      self.__wakeRecv.setblocking(False)
+      self.__wakeSend.setblocking(False)
+      self.__speech = None
+      self.__worker = ActionWorker(lambda name, peer: self.__post(peer, 'done:{};'.format(name)),
+                                   lambda name, peer, e: self.__post(peer, 'error:{},{};'.format(name, e)))
+
+      self.__sampler = Sampler([Sensor('ir', self.__ir.value, float(cfg['ir-interval']), float(cfg['ir-deadband']), keepalive),
+                                Sensor('power', lambda: self.__power.measured_volts, float(cfg['power-interval']), float(cfg['power-deadband']), keepalive)],
+                               self.__wake)
 
-   def __log(self, msg):
-      if not self.quite:
-         print(msg)
+      self.commands = CmdRegistry()
+      self.__registerCommands()
 
    def start(self):
-      self.__log('== EV3 Server ==')
-      self.__log('* starting server {}:{}'.format(self.host, self.port))
+      log.info('== EV3 Server ==')
+      log.info('* starting server %s:%s', self.host, self.port)
       try:
          self.__socket = socket.socket()
+         self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
          self.__socket.bind(('', self.port))
-         self.__socket.listen(1)
+         self.__socket.listen(self.Backlog)
+         self.port = self.__socket.getsockname()[1]
+
+         if self.udpPort is not None:
+            self.__udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__udp.bind(('', self.udpPort))
+            self.__udp.setblocking(False)
+            self.udpPort = self.__udp.getsockname()[1]
+            log.info('* motion channel udp:%s', self.udpPort)
+
          self.__started = True
-         self.__log('* started')
+         log.info('* started')
 
+         # Blink is played by the network loop, peers are served meanwhile
          for i in range(10):
-            ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.RED)
-            ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.RED)
-            time.sleep(0.5)
-            ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.GREEN)
-            ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.GREEN)
-            time.sleep(0.2)
+            self.__timers.schedule(i * 0.7, lambda: self.__led('red'))
+            self.__timers.schedule(i * 0.7 + 0.5, lambda: self.__led('green'))
       except Exception as e:
-         self.__log('* failed to start: {}'.format(e))
+         log.error('* failed to start: %s', e)
 
-   def reply(self):
+   def __post(self, peer, msg):
+      '''Thread safe reply to the peer'''
+      self.__outbox.put((peer, msg))
+      self.__wake()
+
+   def __wake(self):
       try:
-         if time.time() - self.__last_ping > 1.5: 
-            self.__peer_sock.sendall('ping:ok;'.encode()) 
-            self.__last_ping = time.time() 
-    
-         if time.time() - self.__last_pwr > 2: 
-            self.__peer_sock.sendall('power:{};'.format(self.__power.measured_volts).encode()) 
-            self.__last_pwr = time.time() 
-
-         if time.time() - self.__last_ir > 1: 
-            self.__peer_sock.sendall('ir:{};'.format(self.__ir.value()).encode()) 
-            self.__last_ir = time.time() 
-      except:
+         self.__wakeSend.send(b'\0')
+      except OSError:
+         # Wake up buffer is full, loop is going to wake up anyway
          pass
+
+   def __broadcast(self, values):
+      '''Sends (name, value, stamp) telemetry to subscribed peers, every format is encoded once'''
+      self.__telemetrySeq += 1
+      frame = None
+      legacy = None
+      for peer in self.__peers.values():
+         if not peer.telemetry:
+            continue
+         if peer.legacy:
+            legacy = legacy or self.__legacyTelemetryMsg(values)
+            peer.send(legacy)
+         else:
+            frame = frame or self.__telemetryFrame(values)
+            peer.send(frame)
+
+   def __sendSnapshot(self, peer):
+      '''Latest sampled values to a peer that just subscribed, so it does not wait for a change or keep-alive'''
+      values = [(name, value, stamp) for name, (value, stamp) in sorted(self.__sampler.snapshot().items())
+                if value is not None]
+      if values:
+         peer.send(self.__legacyTelemetryMsg(values) if peer.legacy else self.__telemetryFrame(values))
+
+   def __telemetryFrame(self, values):
+      '''tm:seq,time,name=value@stamp,...; single message for all values due in this tick'''
+      items = ['{}={}'.format(name, value) if stamp is None else '{}={}@{:.3f}'.format(name, value, stamp)
+               for name, value, stamp in values]
+      return 'tm:{},{:.3f},{};'.format(self.__telemetrySeq, time.monotonic(), ','.join(items)).encode()
+
+   def __legacyTelemetryMsg(self, values):
+      '''name:value; per value, older clients parse value as a number and know no stamps'''
+      return ''.join('{}:{};'.format(name, value) for name, value, stamp in values).encode()
+
+   def reply(self):
+      while not self.__outbox.empty():
+         peer, msg = self.__outbox.get_nowait()
+         if peer in self.__peers.values():
+            peer.send(msg.encode())
+
+      if not self.__peers:
+         return
+
+      values = []
+      # Monotonic like the timers: the brick has no RTC, an NTP step must not pause pings
+      now = time.monotonic()
+      if now - self.__last_ping > self.__pingInterval:
+         values.append(('ping', 'ok', None))
+         self.__last_ping = now
+
+      # Sample time lets the client judge freshness
+      values.extend(self.__sampler.due())
+      if values:
+         self.__broadcast(values)
+
+   def __scheduleTelemetry(self):
+      '''Wakes the loop at the nearest ping or keep-alive deadline, sensor changes wake it by themselves'''
+      self.__timers.cancel(self.__telemetryTimer)
+      self.__telemetryTimer = None
+      if not self.__peers:
+         return
+      delay = max(0, self.__last_ping + self.__pingInterval - time.monotonic())
+      keepalive = self.__sampler.nextDue()
+      if keepalive is not None:
+         delay = min(delay, keepalive)
+      self.__telemetryTimer = self.__timers.schedule(delay, self.reply)
+
+   def __scheduleWatchdog(self):
+      self.__timers.cancel(self.__watchdogTimer)
+      self.__watchdogTimer = None
+      if self.watchdog and self.__controller is not None:
+         delay = self.__controller.lastInput + self.watchdog - time.monotonic()
+         self.__watchdogTimer = self.__timers.schedule(max(0, delay), self.__checkWatchdog)
+
+   def __checkWatchdog(self):
+      self.__watchdogTimer = None
+      controller = self.__controller
+      if controller is None:
+         return
+      if time.monotonic() - controller.lastInput >= self.watchdog:
+         log.warning('* controller %s is silent, stopping motors', controller.addr)
+         self.__stopMotors()
+         # Check again after next input
+         controller.lastInput = time.monotonic()
+      self.__scheduleWatchdog()
  
-   def handle(self, cmd, value):
-      if cmd == 'speak':
-         self.__log('* Speaking "{}"'.format(value))
-         ev3.Sound.speak(value).wait()
-      elif cmd == 'led':
-         if value == 'green':
-            ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.GREEN)
-            ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.GREEN)
-         elif value == 'red':
-            ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.RED)
-            ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.RED)
-         elif value == 'orange':
-            ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.ORANGE)
-            ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.ORANGE)
-         elif value == 'yellow':
-            ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.YELLOW)
-            ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.YELLOW)
-      elif cmd == 'restart':
-         self.__log('* restarting..')
-
-         ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.YELLOW)
-         ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.YELLOW)
-
-         call(['python3.4', '/usr/local/bin/ev3server.daemon.py', 'restart'])
-      elif cmd == 'update':
-         self.__log('* updating..')
-
-         ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.GREEN)
-         ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.GREEN)
-
-         ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.ORANGE)
-         ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.ORANGE)
-
-         call(['scp', 'root@wrt:ev3server.update/ev3server.daemon.py', '/usr/local/bin'])
-         call(['scp', 'root@wrt:ev3server.update/ev3server.py', '/usr/local/bin'])
-         call(['scp', 'root@wrt:ev3server.update/daemon.py', '/usr/local/bin'])
-         call(['scp', 'root@wrt:ev3server.update/ev3server.cfg', '/usr/local/etc'])
-
-         ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.GREEN)
-         ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.GREEN)
-      elif cmd == 'shutdown':
-         self.__log('* shutting down..')
-
-         ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.RED)
-         ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.RED)
-
-         call(['shutdown', '-h', 'now'])
-      elif cmd == 'xy':
-         x, y = value.split(',')
-         x = float(x)
-         y = float(y)
-         self.__leftMotor.speed_sp = self.__leftMotor.max_speed / self.__gear * x
-         self.__leftMotor.run_forever()
-         self.__rightMotor.speed_sp = self.__rightMotor.max_speed / self.__gear * y
-         self.__rightMotor.run_forever()
-      elif cmd == 'arm':
-         value = float(value)
-         direction = 1 if value > 0 else -1
-         self.__log('* arm {}..'.format('open' if direction == 1 else 'close'))
-         self.__smallMotor.run_timed(time_sp=abs(value), speed_sp=direction * 360)
-      elif cmd == 'gear':
-         self.__gear = int(value)
-      elif cmd == 'arm_open':
-         self.__log('* arm open..')
-         self.__smallMotor.run_timed(time_sp=1000, speed_sp=360)
-      elif cmd == 'arm_close':
-         self.__log('* arm close..')
-         self.__smallMotor.run_timed(time_sp=1000, speed_sp=-360)
-      elif cmd == 'drive':
-         left, right = value.split(',')
-         left = -float(left)
-         right = -float(right)
-         self.__leftMotor.speed_sp = self.__leftMotor.max_speed / self.__gear * left
-         self.__leftMotor.run_forever()
-         self.__rightMotor.speed_sp = self.__rightMotor.max_speed / self.__gear * right
-         self.__rightMotor.run_forever()
-      elif cmd == 'motorA':
-         self.__log('* motorA={}'.format(value))
-      elif cmd == 'motorB':
-         self.__log('* motorB={}'.format(value))
-      elif cmd == 'smallMotor':
-         self.__log('* smallMotor={}'.format(value))
+   def __background(self, name, func, coalesce = False):
+      '''Handler that hands the action over to the worker thread, result goes back to the requesting peer'''
+      def submit(value):
+         if not self.__worker.submit(name, func, value, self.__peer, coalesce):
+            self.__peer.send('error:{},busy;'.format(name).encode())
+      return submit
+
+   def __registerCommands(self):
+      self.commands.register('speak', self.__background('speak', self.__speak, coalesce=True))
+      self.commands.register('silence', self.__silence)
+      self.commands.register('led', self.__led)
+      self.commands.register('restart', self.__background('restart', self.__restart))
+      self.commands.register('update', self.__background('update', self.__update))
+      self.commands.register('shutdown', self.__background('shutdown', self.__shutdown))
+      self.commands.register('xy', self.__xy, floats, motion=True)
+      self.commands.register('arm', self.__arm, float, motion=True)
+      self.commands.register('gear', self.__setGear, int, motion=True)
+      self.commands.register('arm_open', self.__armOpen, motion=True)
+      self.commands.register('arm_close', self.__armClose, motion=True)
+      self.commands.register('drive', self.__drive, floats, motion=True)
+      self.commands.register('control', self.__control)
+      self.commands.register('telemetry', self.__telemetry)
+      self.commands.register('proto', self.__proto)
+      self.commands.register('ping', self.__ping)
+      self.commands.register('udp', self.__registerMotion, int)
+      self.commands.register('stats', self.__stats)
+      self.commands.register('dumplog', self.__dumpLog)
+      self.commands.register('motorA', lambda value: log.info('* motorA=%s', value))
+      self.commands.register('motorB', lambda value: log.info('* motorB=%s', value))
+      self.commands.register('smallMotor', lambda value: log.info('* smallMotor=%s', value))
+
+   def handle(self, cmd, value, parsed = False):
+      handler = self.commands.get(cmd)
+      if handler is not None and handler.motion and self.__peer is not None and not self.__lease(self.__peer):
+         self.__peer.send('error:{},not controller;'.format(cmd).encode())
+         return
+      if not self.commands.dispatch(cmd, value, parsed):
+         log.warning('Unknown command "%s"', cmd)
+
+   def __lease(self, peer):
+      '''First peer sending a motion command takes free controller lease'''
+      if self.__controller is None:
+         self.__controller = peer
+         log.info('* controller %s', peer.addr)
+         peer.send('control:granted;'.encode())
+         self.__scheduleWatchdog()
+      return self.__controller is peer
+
+   def __control(self, value):
+      '''control:take, control:force or control:release'''
+      if value == 'release':
+         if self.__controller is self.__peer:
+            self.__stopMotors()
+            self.__controller = None
+            self.__peer.send('control:released;'.encode())
+         return
+
+      if value == 'force' and self.__controller is not None and self.__controller is not self.__peer:
+         self.__controller.send('control:lost;'.encode())
+         self.__controller = None
+      if not self.__lease(self.__peer):
+         self.__peer.send('control:denied;'.encode())
+
+   def __telemetry(self, value):
+      '''telemetry:on, telemetry:off, telemetry:frame or telemetry:legacy'''
+      self.__peer.telemetry = value != 'off'
+      if value in ['frame', 'legacy']:
+         self.__peer.legacy = value == 'legacy'
+      if self.__peer.telemetry:
+         self.__sendSnapshot(self.__peer)
+
+   def __proto(self, value):
+      '''Protocol handshake, binary frames are accepted anyway, this only tells the client they are understood'''
+      self.__peer.send('proto:{};'.format(ev3proto.VERSION if value == ev3proto.VERSION else 'text').encode())
+
+   def __ping(self, value):
+      '''Echo ping, client measures round trip from its own stamp in the value'''
+      self.__peer.send('ping:{};'.format(value).encode())
+
+   def motorStats(self):
+      return {'left': self.__leftMotor.stats(),
+              'right': self.__rightMotor.stats(),
+              'small': self.__smallMotor.stats()}
+
+   def __dumpLog(self, value):
+      '''dumplog:N writes last N log entries to the dump file, dumplog: writes the whole ring'''
+      count = log.dump(self.logDump, int(value) if value else None)
+      self.__peer.send('dumplog:{},{};'.format(count, self.logDump).encode())
+
+   def __stats(self, value):
+      '''stats:motors replies with sysfs writes done and elided per motor, stats:loop with network loop counters,
+         stats:log with logger counters, stats:sim with simulated sysfs reads and writes, empty on the brick'''
+      if value == 'motors':
+         items = ['{}.{}={}'.format(motor, key, count)
+                  for motor, stats in sorted(self.motorStats().items()) for key, count in sorted(stats.items())]
+      elif value == 'loop':
+         items = ['wakeups={}'.format(self.loopStats['wakeups']),
+                  'timers={}'.format(self.__timers.fired),
+                  'pending={}'.format(len(self.__timers))]
+      elif value == 'log':
+         items = ['{}={}'.format(key, count) for key, count in sorted(log.stats().items())]
+      elif value == 'sim':
+         items = ['{}={}'.format(key, count) for key, count in sorted(ev3.stats().items())] if hasattr(ev3, 'stats') else []
       else:
-         self.__log('Unknown command "{0}"'.format(cmd))
+         return
+      self.__peer.send('stats:{};'.format(','.join(items)).encode())
+
+   def __registerMotion(self, token):
+      '''udp:<token>, datagrams with this token act on behalf of the peer.
+         Reply udp:<port> only says the port is open, udp:ok answers the first probe datagram'''
+      if self.__udp is None:
+         self.__peer.send('udp:off;'.encode())
+         return
+      self.__motionPeers[token] = self.__peer
+      self.__motionSeq.pop(token, None)
+      self.__peer.send('udp:{};'.format(self.udpPort).encode())
+
+   def __readMotion(self):
+      '''Drains pending datagrams, applies only the newest setpoint per token'''
+      latest = {}
+      while True:
+         try:
+            data, addr = self.__udp.recvfrom(64)
+         except (BlockingIOError, InterruptedError):
+            break
+         except OSError:
+            continue
+         self.motionStats['received'] += 1
+         try:
+            token, seq, stamp, cmd, args = ev3proto.decodeMotion(data)
+         except ValueError:
+            self.motionStats['rejected'] += 1
+            continue
+         if token not in self.__motionPeers:
+            self.motionStats['rejected'] += 1
+            continue
+         if seq == 0:
+            # Probe: the peer learns its datagrams get through, nothing is applied
+            self.motionStats['probes'] += 1
+            self.__motionPeers[token].send('udp:ok;'.encode())
+            continue
+         if seq <= self.__motionSeq.get(token, -1) or (token in latest and seq <= latest[token][0]):
+            self.motionStats['stale'] += 1
+            continue
+         if token in latest:
+            # Superseded within this batch
+            self.motionStats['stale'] += 1
+         latest[token] = (seq, cmd, args)
+
+      for token, (seq, cmd, args) in latest.items():
+         self.__motionSeq[token] = seq
+         self.__peer = self.__motionPeers[token]
+         # Steering over udp alone is input for the watchdog too
+         self.__peer.lastInput = time.monotonic()
+         try:
+            self.handle(cmd, args, parsed=True)
+            self.motionStats['applied'] += 1
+         except Exception as e:
+            log.exception('Handle exception: %s', e)
+         finally:
+            self.__peer = None
+
+   def __stopMotors(self):
+      self.__leftMotor.stop()
+      self.__rightMotor.stop()
+
+   def __speak(self, value):
+      log.info('* Speaking "%s"', value)
+      self.__speech = ev3.Sound.speak(value)
+      try:
+         self.__speech.wait()
+      finally:
+         self.__speech = None
+
+   def __silence(self, value):
+      '''Drops queued speech and interrupts the current one'''
+      self.__worker.cancel('speak')
+      speech = self.__speech
+      if speech is not None and hasattr(speech, 'terminate'):
+         speech.terminate()
+
+   def __led(self, value):
+      colors = {'green': ev3.Leds.GREEN,
+                'red': ev3.Leds.RED,
+                'orange': ev3.Leds.ORANGE,
+                'yellow': ev3.Leds.YELLOW}
+      if value in colors:
+         ev3.Leds.set_color(ev3.Leds.LEFT, colors[value])
+         ev3.Leds.set_color(ev3.Leds.RIGHT, colors[value])
+
+   def __restart(self, value):
+      log.info('* restarting..')
+
+      ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.YELLOW)
+      ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.YELLOW)
+
+      call(['python3.4', '/usr/local/bin/ev3server.daemon.py', 'restart'])
+
+   def __update(self, value):
+      log.info('* updating..')
+
+      ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.GREEN)
+      ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.GREEN)
+
+      ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.ORANGE)
+      ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.ORANGE)
+
+      files = [('ev3server.daemon.py', '/usr/local/bin'),
+               ('ev3server.py', '/usr/local/bin'),
+               ('daemon.py', '/usr/local/bin'),
+               ('ev3proto.py', '/usr/local/bin'),
+               ('ev3log.py', '/usr/local/bin'),
+               ('ev3server.cfg', '/usr/local/etc')]
+      failed = [name for name, path in files if call(['scp', 'root@wrt:ev3server.update/' + name, path]) != 0]
+
+      ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.GREEN)
+      ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.GREEN)
+
+      if failed:
+         raise IOError('failed to copy {}'.format(' '.join(failed)))
+
+   def __shutdown(self, value):
+      log.info('* shutting down..')
+
+      ev3.Leds.set_color(ev3.Leds.LEFT, ev3.Leds.RED)
+      ev3.Leds.set_color(ev3.Leds.RIGHT, ev3.Leds.RED)
+
+      call(['shutdown', '-h', 'now'])
+
+   def __xy(self, value):
+      x, y = value
+      self.__leftMotor.runForever(self.__leftMotor.max_speed / self.__gear * x)
+      self.__rightMotor.runForever(self.__rightMotor.max_speed / self.__gear * y)
+
+   def __arm(self, value):
+      direction = 1 if value > 0 else -1
+      log.debug('* arm %s..', 'open' if direction == 1 else 'close')
+      self.__smallMotor.runTimed(time_sp=abs(value), speed_sp=direction * 360)
+
+   def __setGear(self, value):
+      self.__gear = value
+
+   def __armOpen(self, value):
+      log.debug('* arm open..')
+      self.__smallMotor.runTimed(time_sp=1000, speed_sp=360)
+
+   def __armClose(self, value):
+      log.debug('* arm close..')
+      self.__smallMotor.runTimed(time_sp=1000, speed_sp=-360)
+
+   def __drive(self, value):
+      left, right = value
+      left = -left
+      right = -right
+      self.__leftMotor.runForever(self.__leftMotor.max_speed / self.__gear * left)
+      self.__rightMotor.runForever(self.__rightMotor.max_speed / self.__gear * right)
+
+   def __process(self, peer, frames):
+      '''Handles complete frames, returns False if peer asked to disconnect'''
+      self.__peer = peer
+      try:
+         for data in frames:
+            if isinstance(data, tuple):
+               try:
+                  self.handle(data[0], data[1], parsed=True)
+               except Exception as e:
+                  log.exception('Handle exception: %s', e)
+               continue
+
+            if data.lower() == 'quit':
+               log.info('* peer is going to disconnect')
+               return False
+            log.debug('* Received: "%s"', data)
+
+            if ':' in data:
+               try:
+                  cmd, value = data.split(':', 1)
+                  self.handle(cmd.strip(), value.strip())
+               except Exception as e:
+                  log.exception('Handle exception: %s', e)
+      finally:
+         self.__peer = None
+      return True
+
+   def __acceptPeer(self):
+      try:
+         sock, addr = self.__socket.accept()
+      except BlockingIOError:
+         return
+      sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+      sock.setblocking(False)
+      peer = Peer(sock, addr, self.__legacyTelemetry)
+      self.__peers[sock] = peer
+      self.__selector.register(sock, peer.events, peer)
+      log.info('* peer connected %s', addr)
+      self.__sendSnapshot(peer)
+
+   def __closePeer(self, peer):
+      self.__selector.unregister(peer.sock)
+      del self.__peers[peer.sock]
+      peer.sock.close()
+      for token in [token for token, owner in self.__motionPeers.items() if owner is peer]:
+         del self.__motionPeers[token]
+         self.__motionSeq.pop(token, None)
+      if self.__controller is peer:
+         # Nobody controls the rover any more
+         self.__stopMotors()
+         self.__controller = None
+      log.info('* peer disconnected %s', peer.addr)
+
+   def __readPeer(self, peer):
+      try:
+         datas = peer.sock.recv(self.RecvSize)
+      except (BlockingIOError, InterruptedError):
+         return True
+      except OSError:
+         datas = b''
+      if not datas:
+         log.info('* Connection closed')
+         return False
+      peer.lastInput = time.monotonic()
+      return self.__process(peer, peer.parser.feed(datas))
+
+   def __flushPeer(self, peer):
+      try:
+         peer.flush()
+      except (BlockingIOError, InterruptedError):
+         pass
+      except OSError:
+         return False
+
+      events = selectors.EVENT_READ | (selectors.EVENT_WRITE if peer.output else 0)
+      if events != peer.events:
+         peer.events = events
+         self.__selector.modify(peer.sock, events, peer)
+      return True
 
    def accept(self):
+      self.__selector = selectors.DefaultSelector()
+      self.__socket.setblocking(False)
+      self.__selector.register(self.__socket, selectors.EVENT_READ)
+      self.__selector.register(self.__wakeRecv, selectors.EVENT_READ)
+      if self.__udp is not None:
+         self.__selector.register(self.__udp, selectors.EVENT_READ)
+      log.info('* waiting for peers...')
+
       while self.__started:
-         self.__log('* waiting for peer...')
-         self.__peer_sock, self.__peer_addr = self.__socket.accept()
-         self.__peer_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-         self.__log('* peer connected {}'.format(self.__peer_addr))
-         while self.__started:
-            self.reply()
-
-            r, w, x = select.select([self.__peer_sock], [self.__peer_sock], [], 1)
-            if self.__peer_sock in r:
-               datas = self.__peer_sock.recv(128).decode().strip()
-               if not datas:
-                  self.__log('* Connection closed')
-                  break
-
-               for data in datas.split(';'):
-                  data = data.strip()
-                  if data.lower() == 'quit':
-                     self.__log('* peer is going to disconnect')
-                     self.__peer_sock.close()
-                     self.__log('* peer disconnected')
-                     break
-                  self.__log('* Received: "{}"'.format(data))
-
-                  if ':' in data:
-                     try:
-                        cmd, value = data.split(':')
-                        self.handle(cmd.strip(), value.strip())
-                     except Exception as e:
-                        print('Handle exception: {}'.format(e))
-
-            if self.__peer_sock in x:
-               self.__log('* Connection closed')
-               break
+         ready = self.__selector.select(self.__timers.timeout())
+         self.loopStats['wakeups'] += 1
+         for key, events in ready:
+            if key.fileobj is self.__socket:
+               self.__acceptPeer()
+            elif key.fileobj is self.__wakeRecv:
+               try:
+                  self.__wakeRecv.recv(self.RecvSize)
+               except BlockingIOError:
+                  pass
+            elif key.fileobj is self.__udp:
+               self.__readMotion()
+            elif events & selectors.EVENT_READ and key.data.sock in self.__peers:
+               if not self.__readPeer(key.data):
+                  self.__closePeer(key.data)
 
-         self.__peer_sock = None
-         self.__peer_addr = None
+         self.__timers.run()
+         self.reply()
+         self.__scheduleTelemetry()
+
+         for peer in list(self.__peers.values()):
+            if not self.__flushPeer(peer):
+               self.__closePeer(peer)
 
    def stop(self):
-      self.__log('* stopping server')
+      log.info('* stopping server')
       self.__started = False
-      if self.__peer_sock is not None:
-         self.__peer_sock.close()
-         self.__peer_sock = None
+      self.__sampler.stop()
+      for peer in list(self.__peers.values()):
+         peer.sock.close()
+      self.__peers = {}
+      if self.__selector is not None:
+         self.__selector.close()
+         self.__selector = None
       if self.__socket is not None:
          self.__socket.close()
          self.__socket = None
+      if self.__udp is not None:
+         self.__udp.close()
+         self.__udp = None
 
 def run():
    import configparser
    import os
 
-   print('cwd = {}\n'.format(os.getcwd()))
    config = configparser.ConfigParser()
-   config.read('/usr/local/etc/ev3server.cfg')
+   # Installed config overrides the one next to the script, which is enough to run off-brick
+   config.read([os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ev3server.cfg'),
+                '/usr/local/etc/ev3server.cfg'])
+   if config.has_section('sim') and hasattr(ev3, 'configure'):
+      ev3.configure(dict(config['sim']))
 
    srvCfg = config['server']
    port = int(srvCfg['port'])
    quite = srvCfg['quite'] == 'yes' or srvCfg['quite'] == 'true'
+   samplerCfg = dict(config['sampler']) if config.has_section('sampler') else {}
+   legacyTelemetry = srvCfg.get('telemetry', 'frame') == 'legacy'
+   udpPort = int(srvCfg['udp-port']) if srvCfg.get('udp-port') else None
+   watchdog = float(srvCfg.get('watchdog', '30'))
+
+   logCfg = config['log'] if config.has_section('log') else {}
+   log.setLevel(ev3log.parseLevel(logCfg.get('level', 'info')))
+   log.resize(int(logCfg.get('ring', '1000')))
+   if logCfg.get('file'):
+      log.open(logCfg['file'])
+   logDump = logCfg.get('dump', 'ev3server.dump')
+   log.dumpOnCrash(logDump)
+   log.info('cwd = %s', os.getcwd())
 
-   server = EV3Server(port, quite)
+   server = EV3Server(port, quite, samplerCfg, legacyTelemetry, udpPort, watchdog, logDump)
    try:
       server.start()
       server.accept()
    except KeyboardInterrupt:
       pass
    except Exception as e:
-      print('Exception:', e)
+      log.exception('Exception: %s', e)
+      log.dump(logDump)
    finally:
       server.stop()
+      log.close()
 
 if __name__ == '__main__':
    run()
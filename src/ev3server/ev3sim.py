@@ -0,0 +1,309 @@
+#!/usr/bin/python3.4
+# @file ev3sim.py
+#
+# Simulated ev3dev.ev3 devices, ev3server uses them when ev3dev is not installed.
+# Motors ramp towards speed_sp and integrate position, the rover travels a straight track
+# with obstacles seen by the IR sensor, battery discharges with motor load.
+# Every attribute read and write costs configurable sysfs-like latency.
+
+import math
+import time
+import random
+import threading
+
+# [sim] section of ev3server.cfg overrides these, see configure()
+Defaults = {'read-latency': '0',          # seconds per attribute read
+            'write-latency': '0',         # seconds per attribute write or command
+            'ramp-up': '300',             # ms from 0 to max_speed
+            'ramp-down': '300',           # ms from max_speed to 0
+            'polarity': 'inversed',       # inversed: negative wheel speed drives forward
+            'wheel-diameter': '5.6',      # cm
+            'obstacles': '150',           # cm ahead of the start point, comma separated
+            'ir-noise': '0.5',            # IR units, uniform
+            'battery-full': '8.3',        # volts
+            'battery-empty': '6.5',       # volts
+            'battery-capacity': '2.05',   # Ah
+            'battery-charge': '1',        # 0..1 at start
+            'battery-resistance': '0.3',  # ohm
+            'idle-current': '0.15',       # A
+            'motor-current': '0.6'}       # A per motor at max_speed
+
+config = dict(Defaults)
+
+IR_CM_PER_UNIT = 0.7   # proximity 100 is ~70 cm
+
+def configure(cfg):
+   '''Applies settings and restarts the world: battery is recharged, rover is back at start'''
+   config.update(cfg)
+   world.reset()
+
+def stats():
+   return {'reads': world.reads, 'writes': world.writes}
+
+def read():
+   world.reads += 1
+   latency = float(config['read-latency'])
+   if latency:
+      time.sleep(latency)
+
+def write():
+   world.writes += 1
+   latency = float(config['write-latency'])
+   if latency:
+      time.sleep(latency)
+
+class World:
+   '''Rover on a straight track: large motors move it, obstacles are seen by IR, motors drain the battery'''
+   def __init__(self):
+      self.lock = threading.RLock()
+      self.motors = []
+      self.reads = 0
+      self.writes = 0
+      self.reset()
+
+   def reset(self):
+      with self.lock:
+         self.obstacles = sorted(float(v) for v in config['obstacles'].split(',') if v.strip())
+         self.__capacity = float(config['battery-capacity']) * 3600
+         self.__used = (1 - float(config['battery-charge'])) * self.__capacity
+         self.__start = time.monotonic()
+         self.__travel = sum(motor.travel() for motor in self.motors)
+         self.__origin = self.__wheelCounts()
+
+   def __wheelCounts(self):
+      wheels = [motor for motor in self.motors if isinstance(motor, LargeMotor)]
+      if not wheels:
+         return 0
+      return sum(motor.tacho() for motor in wheels) / len(wheels)
+
+   def position(self):
+      '''cm travelled forward from the start point'''
+      with self.lock:
+         counts = self.__wheelCounts() - self.__origin
+      if config['polarity'] == 'inversed':
+         counts = -counts
+      return counts / LargeMotor.count_per_rot * math.pi * float(config['wheel-diameter'])
+
+   def distance(self):
+      '''cm to the nearest obstacle ahead, None if the track is clear'''
+      position = self.position()
+      ahead = [obstacle - position for obstacle in self.obstacles if obstacle >= position]
+      return min(ahead) if ahead else None
+
+   def amps(self):
+      with self.lock:
+         load = sum(abs(motor.tacho(speed=True)) / motor.max_speed for motor in self.motors)
+      return float(config['idle-current']) + float(config['motor-current']) * load
+
+   def volts(self):
+      with self.lock:
+         now = time.monotonic()
+         # Motor current is proportional to speed, so drawn charge is proportional to travel
+         travel = sum(motor.travel() / motor.max_speed for motor in self.motors)
+         used = self.__used + float(config['idle-current']) * (now - self.__start) + \
+                float(config['motor-current']) * (travel - self.__travel)
+      charge = max(0.0, 1 - used / self.__capacity)
+      full = float(config['battery-full'])
+      empty = float(config['battery-empty'])
+      return max(0.0, empty + (full - empty) * charge - float(config['battery-resistance']) * self.amps())
+
+class Motor:
+   '''Tacho motor: speed ramps linearly towards the target, position is the exact integral of speed'''
+   max_speed = 1050
+   count_per_rot = 360
+
+   def __init__(self, address = None):
+      self.address = address
+      self.__speed_sp = 0
+      self.__time_sp = 0
+      self.ramp_up_sp = int(config['ramp-up'])
+      self.ramp_down_sp = int(config['ramp-down'])
+      self.__speed = 0.0
+      self.__position = 0.0
+      self.__travel = 0.0   # integral of abs(speed)
+      self.__target = 0.0
+      self.__deadline = None   # end of a timed run
+      self.__stamp = time.monotonic()
+      with world.lock:
+         world.motors.append(self)
+
+   @property
+   def speed_sp(self):
+      read()
+      return self.__speed_sp
+
+   @speed_sp.setter
+   def speed_sp(self, value):
+      write()
+      self.__speed_sp = max(-self.max_speed, min(self.max_speed, int(value)))
+
+   @property
+   def time_sp(self):
+      read()
+      return self.__time_sp
+
+   @time_sp.setter
+   def time_sp(self, value):
+      write()
+      self.__time_sp = int(value)
+
+   @property
+   def position(self):
+      read()
+      return int(self.tacho())
+
+   @property
+   def speed(self):
+      read()
+      return int(self.tacho(speed=True))
+
+   @property
+   def state(self):
+      read()
+      with world.lock:
+         self.__advance(time.monotonic())
+         return ['running'] if self.__target or self.__speed else []
+
+   def run_forever(self, **kwargs):
+      self.__set(kwargs)
+      write()
+      with world.lock:
+         self.__advance(time.monotonic())
+         self.__target = float(self.__speed_sp)
+         self.__deadline = None
+
+   def run_timed(self, **kwargs):
+      self.__set(kwargs)
+      write()
+      with world.lock:
+         now = time.monotonic()
+         self.__advance(now)
+         self.__target = float(self.__speed_sp)
+         self.__deadline = now + self.__time_sp / 1000.0
+
+   def stop(self, **kwargs):
+      self.__set(kwargs)
+      write()
+      with world.lock:
+         self.__advance(time.monotonic())
+         self.__target = 0.0
+         self.__deadline = None
+
+   def __set(self, attrs):
+      for name, value in attrs.items():
+         setattr(self, name, value)
+
+   def tacho(self, speed = False):
+      '''Current position, or speed, without sysfs cost'''
+      with world.lock:
+         self.__advance(time.monotonic())
+         return self.__speed if speed else self.__position
+
+   def travel(self):
+      with world.lock:
+         self.__advance(time.monotonic())
+         return self.__travel
+
+   def __advance(self, now):
+      if self.__deadline is not None and self.__deadline <= now:
+         self.__integrate(self.__deadline)
+         self.__target = 0.0
+         self.__deadline = None
+      self.__integrate(now)
+
+   def __integrate(self, now):
+      dt = now - self.__stamp
+      self.__stamp = now
+      if dt <= 0:
+         return
+      v0 = self.__speed
+      target = self.__target
+      ramp = self.ramp_up_sp if abs(target) > abs(v0) else self.ramp_down_sp
+      accel = self.max_speed / (ramp / 1000.0) if ramp > 0 else float('inf')
+      reach = abs(target - v0) / accel
+      if dt < reach:
+         v1 = v0 + math.copysign(accel * dt, target - v0)
+         self.__segment(v0, v1, dt)
+         self.__speed = v1
+      else:
+         self.__segment(v0, target, reach)
+         self.__segment(target, target, dt - reach)
+         self.__speed = target
+
+   def __segment(self, v0, v1, dt):
+      '''Linear speed change over dt'''
+      if dt <= 0:
+         return
+      self.__position += (v0 + v1) / 2 * dt
+      if v0 * v1 >= 0:
+         self.__travel += abs(v0 + v1) / 2 * dt
+      else:
+         # Passes zero, both parts are triangles
+         self.__travel += (v0 * v0 + v1 * v1) / (2 * abs(v1 - v0)) * dt
+
+class LargeMotor(Motor):
+   max_speed = 1050
+
+class MediumMotor(Motor):
+   max_speed = 1560
+
+class InfraredSensor:
+   '''Proximity 0..100 to the nearest obstacle ahead'''
+   def __init__(self, address = None):
+      self.address = address
+
+   def value(self, n = 0):
+      read()
+      distance = world.distance()
+      if distance is None:
+         return 100
+      noise = random.uniform(-1, 1) * float(config['ir-noise'])
+      return int(max(0, min(100, distance / IR_CM_PER_UNIT + noise)))
+
+   @property
+   def proximity(self):
+      return self.value()
+
+class PowerSupply:
+   @property
+   def measured_volts(self):
+      read()
+      return world.volts()
+
+   @property
+   def measured_amps(self):
+      read()
+      return world.amps()
+
+class Leds:
+   LEFT = 'left'
+   RIGHT = 'right'
+   RED = 'red'
+   GREEN = 'green'
+   ORANGE = 'orange'
+   YELLOW = 'yellow'
+
+   colors = {}
+
+   @staticmethod
+   def set_color(group, color):
+      # Red and green brightness of a led pair
+      write()
+      write()
+      Leds.colors[group] = color
+
+class Sound:
+   '''speak() returns at once, wait() blocks for roughly the time espeak would talk'''
+   SecPerChar = 0.06
+
+   def __init__(self, duration = 0):
+      self.__end = time.monotonic() + duration
+
+   @staticmethod
+   def speak(text):
+      return Sound(len(text) * Sound.SecPerChar)
+
+   def wait(self):
+      time.sleep(max(0, self.__end - time.monotonic()))
+
+world = World()
@@ -15,7 +15,8 @@ echo "led:red" | nc wrt 88
 echo 8
 scp daemon.py root@192.168.1.120:ev3server.update
 echo 9
-scp daemon.py root@192.168.1.120:ev3server.update
+scp ev3proto.py root@192.168.1.120:ev3server.update
+scp ev3log.py root@192.168.1.120:ev3server.update
 echo 10 
 echo "led:yellow" | nc wrt 88
 echo 11 